@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+
+"""Regression benchmark for huge multi-line query bodies.
+
+Writes a slow log with one INSERT statement spanning 50000 lines between a
+few ordinary entries and times mysql_filter_slow_log.py on it, reading from
+a file (mmap) and from STDIN (line parser), with and without
+--max-query-bytes. Query body concatenation used to be quadratic in the
+number of lines, so every run should finish well below a second.
+
+The log also holds an unterminated string of as many escaped quotes (as
+left by a truncated log line), which used to make --fingerprint backtrack
+quadratically. It ends without a trailing newline, the output of each
+option is checked to be the same for the file and STDIN. So is the output
+of a short log ending with an incomplete "# " header line.
+
+Usage:
+
+python benchmarks/bench_long_query.py [lines] [max_seconds]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                      'mysql_filter_slow_log.py')
+
+
+def write_log(f, lines):
+    """Write a slow log with one INSERT statement of the given line count."""
+
+    entry = '# Time: 070119 12:29:%02d\n'\
+            '# User@Host: root[root] @ localhost []\n'\
+            '# Query_time: %d  Lock_time: 0  Rows_sent: 0  Rows_examined: %d\n'
+    f.write(entry % (57, 2, 10))
+    f.write('SELECT * FROM test;\n')
+    f.write(entry % (58, 4, 0))
+    f.write("SELECT * FROM test WHERE name='%s\n" % ("\\'" * lines))
+    f.write(entry % (58, 9, 0))
+    f.write('INSERT INTO test (id, name, value) VALUES\n')
+    for i in xrange(lines - 1):
+        f.write("(%d, 'name %d', %d.5),\n" % (i, i, i * 7))
+    f.write("(%d, 'last', 0.5);\n" % lines)
+    f.write(entry % (59, 3, 12345))
+    f.write('SELECT * FROM test WHERE id=1;')
+
+def run(args, stdin=None):
+    """Return the wall time and output of one filter run with the given
+    arguments."""
+
+    start = time.time()
+    process = subprocess.Popen([sys.executable, script] + args,
+                               stdin=stdin, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    seconds = time.time() - start
+    if process.returncode:
+        raise SystemExit('ERROR: %s exited with status %d'
+                         % (script, process.returncode))
+    return seconds, output
+
+def run_file_and_stdin(name, args):
+    """Return the wall times of one filter run reading the file name and one
+    reading it from STDIN and whether their output is the same."""
+
+    seconds, file_output = run(args + [name])
+    stdin = open(name, 'r')
+    try:
+        stdin_seconds, stdin_output = run(args, stdin)
+    finally:
+        stdin.close()
+    return seconds, stdin_seconds, file_output == stdin_output
+
+
+if __name__ == '__main__':
+    lines = 50000
+    max_seconds = 0
+    for i, arg in enumerate(sys.argv[1:3]):
+        try:
+            if i == 0: lines = abs(int(arg)) or lines
+            else: max_seconds = abs(float(arg))
+        except ValueError, e:
+            if arg[:1] == '-':
+                print >>sys.stderr, __doc__
+                sys.exit()
+            print >>sys.stderr, 'ERROR: Invalid argument %s' % arg
+            sys.exit(1)
+
+    fd, name = tempfile.mkstemp(suffix='.log')
+    f = os.fdopen(fd, 'w')
+    fd, short_name = tempfile.mkstemp(suffix='.log')
+    short = os.fdopen(fd, 'w')
+    try:
+        write_log(f, lines)
+        f.close()
+        write_log(short, 10)
+        short.write('\n# ')
+        short.close()
+        slowest = 0
+        different = []
+        for label, args in (('', []),
+                            (', --no-duplicates', ['--no-duplicates']),
+                            (', --fingerprint', ['--no-duplicates',
+                                                 '--fingerprint']),
+                            (', --fingerprint --details=3',
+                             ['--no-duplicates', '--fingerprint', '--details=3']),
+                            (', --max-query-bytes', ['--max-query-bytes=1024'])):
+            seconds, stdin_seconds, same = run_file_and_stdin(name,
+                                                              ['-T=1'] + args)
+            slowest = max(slowest, seconds, stdin_seconds)
+            print '%-32s %7.3f s' % ('file' + label, seconds)
+            print '%-32s %7.3f s' % ('STDIN' + label, stdin_seconds)
+            if not same:
+                different.append(label[2:] or 'no options')
+        for args in ([], ['--no-duplicates']):
+            if not run_file_and_stdin(short_name, args)[2]:
+                different.append(' '.join(['log ending with "# "'] + args))
+    finally:
+        os.unlink(name)
+        os.unlink(short_name)
+
+    if different:
+        print >>sys.stderr, 'ERROR: file and STDIN output differ with %s'\
+                            % '; '.join(different)
+        sys.exit(1)
+    if max_seconds and slowest > max_seconds:
+        print >>sys.stderr, 'ERROR: slowest run took %.3f s (limit %.3f s)'\
+                            % (slowest, max_seconds)
+        sys.exit(1)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+
+"""Benchmark of the parse, filter, aggregation, sort and --incremental
+phases of mysql_filter_slow_log.py on a synthetic slow log.
+
+The log is written by generate_slow_log.py (or given with --log). Each
+phase runs in its own process through the library API:
+
+parse        iter_entries() of all entries with their timestamps
+filter       iter_entries() with the -T=2 -eu=user1 -iq=orders filters (and
+             the timestamps)
+aggregate    Aggregator.add() of all parsed entries (--no-duplicates)
+sort         sort_report() of all unique queries with --top=20
+incremental  write_stats() of all --incremental stats rows into a new
+             SQLite database
+
+Only the phase itself is timed; aggregate, sort and incremental parse
+(and aggregate) the log untimed before. Of --repeat runs the fastest is
+reported: wall and CPU seconds, log MB/s for the phases reading the log,
+records per second (log entries, unique queries for sort and stats rows
+for incremental) and the phase RSS in KB, by which the peak RSS during the
+phase exceeds the RSS after its untimed preparation. The peak is reset
+before the phase where Linux allows it, otherwise it may be the one of
+the preparation.
+
+Usage:
+
+python benchmarks/bench_phases.py [options] [generator options]
+
+--log=file         Benchmark file instead of a generated log
+--script=file      Benchmark another version of mysql_filter_slow_log.py
+                   (it needs the library API)
+--phases=a,b       Run only these phases [default: all]
+--repeat=N         Run each phase N times [default: 3]
+--output=file      Save the results as JSON
+--compare=file     Print the speedup against the JSON results of an earlier run
+
+Generator options (see generate_slow_log.py) default to 100000 entries.
+"""
+
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate_slow_log
+
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                      'mysql_filter_slow_log.py')
+phases = ['parse', 'filter', 'aggregate', 'sort', 'incremental']
+# Phases reading the log, their throughput is also measured in MB/s
+log_phases = ['parse', 'filter']
+rss_baseline = 0 # KB, set by start_phase()
+
+
+def load_filter(name):
+    """Import the mysql_filter_slow_log.py file name as module."""
+
+    import imp
+    sys.dont_write_bytecode = True # No .pyc next to the benchmarked file
+    return imp.load_source('mysql_filter_slow_log', name)
+
+def aggregate(slowlog, name, args):
+    """Return an Aggregator of all entries of the log name, not timed."""
+
+    slowlog.parse_args(args)
+    aggregator = slowlog.Aggregator()
+    f = open(name, 'r')
+    try:
+        for entry in slowlog.iter_entries(f, True):
+            aggregator.add(entry)
+    finally:
+        f.close()
+    return aggregator
+
+def run_phase(phase, name, script_name):
+    """Run one phase in this process, return (seconds, CPU seconds, records)."""
+
+    slowlog = load_filter(script_name)
+    if phase in log_phases:
+        slowlog.parse_args(phase == 'filter' and
+                           ['-T=2', '-eu=user1', '-iq=orders'] or ['-T=0'])
+        # iter_entries() parses the timestamps regardless of the options,
+        # versions without its timestamps argument only with this
+        slowlog.parse_timestamps = True
+        f = open(name, 'r')
+        try:
+            records = 0
+            start, cpu_start = start_phase()
+            for entry in slowlog.iter_entries(f, phase == 'filter'):
+                records += 1
+            return time.time() - start, time.clock() - cpu_start, records
+        finally:
+            f.close()
+
+    if phase == 'aggregate':
+        slowlog.parse_args(['-T=0', '--no-duplicates'])
+        f = open(name, 'r')
+        try:
+            entries = list(slowlog.iter_entries(f, True))
+        finally:
+            f.close()
+        aggregator = slowlog.Aggregator()
+        start, cpu_start = start_phase()
+        for entry in entries:
+            aggregator.add(entry)
+        return time.time() - start, time.clock() - cpu_start, len(entries)
+
+    if phase == 'sort':
+        aggregator = aggregate(slowlog, name, ['-T=0', '--no-duplicates',
+                                               '--top=20'])
+        start, cpu_start = start_phase()
+        slowlog.sort_report(aggregator)
+        return time.time() - start, time.clock() - cpu_start,\
+               len(aggregator.queries)
+
+    # The database is written to the current directory
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        aggregator = aggregate(slowlog, os.path.join(cwd, name),
+                               ['-T=0', '--no-duplicates', '--incremental'])
+        rows = aggregator.db_rows
+        records = len(rows)
+        start, cpu_start = start_phase()
+        con = slowlog.open_database()
+        for i in xrange(0, records, slowlog.db_batch_size):
+            slowlog.write_stats(con, rows[i:i+slowlog.db_batch_size])
+        con.commit()
+        con.close()
+        return time.time() - start, time.clock() - cpu_start, records
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+def start_phase():
+    """Take the RSS baseline of the phase after its untimed preparation and
+    return its start time and CPU time."""
+
+    global rss_baseline
+    try:
+        # Only the peak RSS of the phase itself is kept in VmHWM (Linux 4.0+)
+        f = open('/proc/self/clear_refs', 'w')
+        try:
+            f.write('5')
+        finally:
+            f.close()
+    except IOError, e:
+        pass
+    rss_baseline = current_rss()
+    return time.time(), time.clock()
+
+def current_rss():
+    """Return the RSS of this process in KB, its peak if the current one is
+    unknown."""
+
+    try:
+        f = open('/proc/self/statm', 'r')
+        try:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+        finally:
+            f.close()
+    except (IOError, ValueError, IndexError), e:
+        return peak_rss()
+
+def peak_rss():
+    """Return the peak RSS of this process in KB."""
+
+    try:
+        f = open('/proc/self/status', 'r')
+        try:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) # reset by start_phase()
+        finally:
+            f.close()
+    except (IOError, ValueError), e:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024 # bytes
+    return rss
+
+def measure(phase, name, script_name):
+    """Return the results of one phase run in a new process."""
+
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                '--run-phase=' + phase, '--script=' + script_name,
+                                '--log=' + name], stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise SystemExit('ERROR: phase %s exited with status %d'
+                         % (phase, process.returncode))
+    return json.loads(output)
+
+def print_results(results, baseline=None):
+    """Print the phase results as table, with the speedup against baseline."""
+
+    print '%-12s %9s %9s %9s %12s %10s%s' % ('phase', 'seconds', 'cpu', 'MB/s',
+          'records/s', 'phase RSS', baseline and '   speedup' or '')
+    for phase in phases:
+        if phase not in results['phases']:
+            continue
+        result = results['phases'][phase]
+        speedup = ''
+        if baseline and phase in baseline['phases']:
+            speedup = '   %6.2fx' % (baseline['phases'][phase]['seconds'] /
+                                     max(result['seconds'], 1e-9))
+        print '%-12s %9.3f %9.3f %9s %12.0f %7d KB%s' % (phase,
+              result['seconds'], result['cpu_seconds'],
+              result['mb_per_s'] is not None and '%.1f' % result['mb_per_s'] or '-',
+              result['records_per_s'], result['phase_rss_kb'], speedup)
+
+
+if __name__ == '__main__':
+    options = dict(generate_slow_log.default_options)
+    log = None
+    script_name = script
+    selected = phases
+    repeat = 3
+    output = None
+    compare = None
+    run_phase_name = None
+    for arg in sys.argv[1:]:
+        try:
+            if generate_slow_log.parse_option(arg, options): pass
+            elif '--log=' == arg[:6]: log = arg[6:]
+            elif '--script=' == arg[:9]: script_name = arg[9:]
+            elif '--phases=' == arg[:9]:
+                selected = [phase for phase in phases if phase in arg[9:].split(',')]
+            elif '--repeat=' == arg[:9]: repeat = max(abs(int(arg[9:])), 1)
+            elif '--output=' == arg[:9]: output = arg[9:]
+            elif '--compare=' == arg[:10]: compare = arg[10:]
+            elif '--run-phase=' == arg[:12]: run_phase_name = arg[12:]
+            else:
+                print >>sys.stderr, __doc__
+                sys.exit()
+        except ValueError, e:
+            print >>sys.stderr, 'ERROR: Invalid option %s' % arg
+            sys.exit(1)
+
+    if run_phase_name:
+        # Child process of measure()
+        seconds, cpu_seconds, records = run_phase(run_phase_name, log,
+                                                  script_name)
+        print json.dumps({'seconds': seconds, 'cpu_seconds': cpu_seconds,
+                          'records': records,
+                          'phase_rss_kb': max(peak_rss() - rss_baseline, 0)})
+        sys.exit()
+
+    baseline = None
+    if compare:
+        f = open(compare, 'r')
+        baseline = json.load(f)
+        f.close()
+
+    name = log
+    if log is None:
+        fd, name = tempfile.mkstemp(suffix='.log')
+        f = os.fdopen(fd, 'w')
+        generate_slow_log.write_log(f, options)
+        f.close()
+    try:
+        size = os.path.getsize(name)
+        results = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'script': os.path.abspath(script_name),
+                   'log': log, 'generator': log is None and options or None,
+                   'log_bytes': size, 'repeat': repeat, 'phases': {}}
+        for phase in selected:
+            runs = [measure(phase, name, script_name) for i in xrange(repeat)]
+            best = min(runs, key=lambda run: run['seconds'])
+            seconds = max(best['seconds'], 1e-9)
+            results['phases'][phase] = {
+                'seconds': best['seconds'],
+                'cpu_seconds': best['cpu_seconds'],
+                'records': best['records'],
+                'records_per_s': best['records'] / seconds,
+                'mb_per_s': phase in log_phases and size / seconds / 1048576 or None,
+                'phase_rss_kb': max([run['phase_rss_kb'] for run in runs])}
+    finally:
+        if log is None:
+            os.unlink(name)
+
+    print 'log: %s, %.1f MB, Python %s' % (log or 'generated', size / 1048576.0,
+                                           results['python'])
+    print_results(results, baseline)
+    if output:
+        f = open(output, 'w')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+        f.close()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+
+"""Deterministic synthetic MySQL slow log generator for benchmarks.
+
+The same options always write the same log, independent of the time zone.
+New unique queries appear throughout the log with the probability
+--unique-ratio, all other entries repeat an earlier query with a skewed
+(Zipf like) popularity, so that a few queries dominate like in real logs.
+
+Usage:
+
+python benchmarks/generate_slow_log.py [options] > slow.log
+
+--entries=N            Number of log entries [default: 100000]
+--unique-ratio=R       Share of entries with a new unique query [default: 0.01]
+--multi-line-ratio=R   Share of unique queries which are multi-line INSERT
+                       batches with one row per line [default: 0.1]
+--query-lines=N        Maximum number of lines of a multi-line query [default: 50]
+--users=N              Number of different users [default: 20]
+--hosts=N              Number of different hosts [default: 50]
+--time-format=classic|iso|mixed
+                       "# Time: 070119 12:29:58", only written if the second
+                       changed like MySQL 5.1 does, "# Time: 2007-01-19T12:29:58.123456Z"
+                       like MySQL 5.6+ does, or both by turns [default: classic]
+--seed=N               Random seed [default: 1]
+"""
+
+import random
+import sys
+import time
+
+
+default_options = {'entries': 100000, 'unique-ratio': 0.01,
+                   'multi-line-ratio': 0.1, 'query-lines': 50, 'users': 20,
+                   'hosts': 50, 'time-format': 'classic', 'seed': 1}
+tables = ['users', 'orders', 'items', 'sessions', 'payments', 'events',
+          'accounts', 'messages']
+start_time = 1169164800 # 2007-01-19 00:00:00 UTC
+
+
+def parse_option(arg, options):
+    """Set one --name=value generator option, return False if arg is none."""
+
+    name, value = (arg[2:].split('=', 1) + [''])[:2]
+    if arg[:2] != '--' or name not in default_options:
+        return False
+    if name == 'time-format':
+        if value not in ('classic', 'iso', 'mixed'):
+            raise SystemExit('ERROR: Unknown time format %s' % value)
+        options[name] = value
+    elif name in ('unique-ratio', 'multi-line-ratio'):
+        options[name] = min(abs(float(value)), 1.0)
+    else:
+        options[name] = max(abs(int(value)), 1)
+    return True
+
+def make_query(k, options):
+    """Return the unique query number k, one string of one or more lines."""
+
+    rng = random.Random(options['seed'] * 1000003 + k)
+    table = rng.choice(tables)
+    if rng.random() < options['multi-line-ratio']:
+        rows = ["(%d, 'name %d', %d.5)" % (k, i, rng.randint(0, 99999))
+                for i in xrange(rng.randint(1, options['query-lines'] - 1))]
+        return 'INSERT INTO %s (id, name, value) VALUES\n%s;' % (table,
+               ',\n'.join(rows))
+    kind = k % 4
+    if kind == 0:
+        return "SELECT id, name, status FROM %s WHERE id = %d AND status = "\
+               "'state%d';" % (table, k, rng.randint(0, 9))
+    if kind == 1:
+        return 'UPDATE %s SET status = %d, updated = NOW() WHERE id IN (%s);'\
+               % (table, rng.randint(0, 9), ', '.join([str(k)] +
+               [str(rng.randint(1, 99999)) for i in xrange(rng.randint(0, 20))]))
+    if kind == 2:
+        return "DELETE FROM %s WHERE created < '2007-01-%02d' AND id > %d "\
+               "LIMIT %d;" % (table, rng.randint(1, 28), k, rng.randint(1, 1000))
+    return 'SELECT t1.id, COUNT(*) FROM %s t1 JOIN %s t2 ON t2.id = t1.ref_id '\
+           'WHERE t1.value > %d GROUP BY t1.id ORDER BY 2 DESC LIMIT %d;' % (
+           table, rng.choice(tables), k, rng.randint(1, 100))
+
+def write_log(f, options):
+    """Write the synthetic slow log of options to f, return its entry count."""
+
+    rng = random.Random(options['seed'])
+    time_format = options['time-format']
+    unique_ratio = options['unique-ratio']
+    users = options['users']
+    hosts = options['hosts']
+    unique_count = 0
+    t = start_time
+    last_t = None
+    for i in xrange(options['entries']):
+        if not unique_count or rng.random() < unique_ratio:
+            k = unique_count
+            unique_count += 1
+        else:
+            k = int((unique_count + 1) ** rng.random()) - 1
+        t += rng.choice((0, 0, 0, 1, 1, 2, 5))
+        microseconds = rng.randint(0, 999999)
+        host = rng.randrange(hosts)
+        user = rng.randrange(users)
+        query_time = min(int(rng.expovariate(0.4)), 600)
+        rows_sent = rng.randint(0, 1000)
+        rows_examined = rows_sent + int(rng.expovariate(0.0001))
+
+        lines = []
+        if time_format == 'iso' or time_format == 'mixed' and i % 2:
+            lines.append('# Time: %s.%06dZ\n' % (time.strftime(
+                         '%Y-%m-%dT%H:%M:%S', time.gmtime(t)), microseconds))
+        elif t != last_t:
+            lines.append('# Time: %s\n' % time.strftime('%y%m%d %H:%M:%S',
+                                                        time.gmtime(t)).replace(' 0', '  ', 1))
+        last_t = t
+        lines.append('# User@Host: user%d[user%d] @ host%d [10.0.%d.%d]\n' % (
+                     user, user, host, host // 256, host % 256))
+        lines.append('# Query_time: %d  Lock_time: %d  Rows_sent: %d  '
+                     'Rows_examined: %d\n' % (query_time, query_time > 3 and
+                     rng.randint(0, 1) or 0, rows_sent, rows_examined))
+        lines.append(make_query(k, options))
+        lines.append('\n')
+        f.write(''.join(lines))
+    return options['entries']
+
+
+if __name__ == '__main__':
+    options = dict(default_options)
+    for arg in sys.argv[1:]:
+        try:
+            if not parse_option(arg, options):
+                print >>sys.stderr, __doc__
+                sys.exit()
+        except ValueError, e:
+            print >>sys.stderr, 'ERROR: Invalid option %s' % arg
+            sys.exit(1)
+    write_log(sys.stdout, options)
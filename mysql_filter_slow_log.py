@@ -46,10 +46,30 @@ log-queries-not-using-indexes
 
 
 Required Python modules:
-- sqlite3 (included in Python 2.5) or pysqlite2 for --incremental
+- sqlite3 (included in Python 2.5) or pysqlite2 for --incremental and --report-from-db
+- multiprocessing (included in Python 2.6) for --jobs
+- lzma (included in Python 3.3) or backports.lzma for .xz files, if the xz command is not available
+- zstandard for .zst files, if the zstd command is not available
 
 
-Example input lines:
+The filter can also be imported as a module, i.e. to collect statistics of
+several logs in your own program (the options are set like on the command line):
+
+import mysql_filter_slow_log as slowlog
+slowlog.parse_args(['-T=3', '--no-duplicates', '--top=10'])
+aggregator = slowlog.Aggregator()
+for entry in slowlog.iter_entries(open('linux-slow.log'), filtered=True):
+    aggregator.add(entry) # (query, user, host, timestamp, t, query_time)
+aggregator.report()
+
+Filter stages like slowlog.filter_users() can be chained on the unfiltered
+entries with slowlog.filter_entries(slowlog.iter_entries(f)). The entries
+of iter_entries() always have their parsed timestamp t (unless it is called
+with timestamps=False), parse_entries() and parse_buffer() parse it only if
+the options need it or with timestamps=True.
+
+
+Example input lines (MySQL 5.6+ writes "# Time: 2007-01-19T12:29:58.123456Z"):
 
 # Time: 070119 12:29:58
 # User@Host: root[root] @ localhost []
@@ -73,6 +93,31 @@ tail -f -n 0 linux-slow.log | python mysql_filter_slow_log.py -T=3 -R=10000 -eu=
 # Stop permanent filtering
 kill `ps auxww | grep 'tail -f -n 0 linux-slow.log' | egrep -v grep | awk '{print $2}'`
 
+# The same with hourly statistics of unique queries, which are also saved incrementally
+python mysql_filter_slow_log.py -T=3 -R=10000 -eu=root -eu=test --no-duplicates --incremental --follow --flush-interval=3600 linux-slow.log &
+
+# Collect the statistics of two logs in the background and ask for the 10 slowest queries at any time
+python mysql_filter_slow_log.py -T=1 --daemon=/tmp/slow-log.sock db01=/logs/db01/slow.log db02=/logs/db02/slow.log &
+python mysql_filter_slow_log.py --query-daemon=/tmp/slow-log.sock --sort=mqt --top=10
+
+# Weekly report of rotated and compressed logs (gzip, bzip2, xz and zstd files are detected automatically)
+python mysql_filter_slow_log.py -T=3 --no-duplicates --top=20 linux-slow.log.1 linux-slow.log.*.gz
+
+# Fleet-wide report of the logs of all replicas, each query with the servers it was logged by
+python mysql_filter_slow_log.py -T=3 --no-duplicates --jobs=8 db01=/logs/db01/slow.log* db02=/logs/db02/slow.log* @more-replicas.txt
+
+
+Input files:
+
+file           Read file, may be compressed [multiple]
+'pattern'      Read all files matching the glob pattern (quoted if your shell should not expand it) [multiple]
+source=file    Tag all queries of file or pattern with source (i.e. the server name) [multiple]
+@manifest      Read all files or source=files listed in manifest, one per line (# starts a comment) [multiple]
+
+Queries of different files are merged in the order of their timestamps. If there is more than one file
+or any source tag, the sources are printed ("# Source:" or "# Sources:" with their execution counts);
+files without a tag are their own source.
+
 
 Options:
 
@@ -84,6 +129,9 @@ Options:
 -iu=include_user  Include only queries which contain include_user in the user field [multiple]
 -eu=exclude_user  Exclude all queries which contain exclude_user in the user field [multiple]
 -iq=include_query Include only queries which contain the string include_query (i.e. database or table name) [multiple]
+-eq=exclude_query Exclude all queries which contain the string exclude_query [multiple]
+--include-query-regex=regex Include only queries which match the regular expression regex [multiple]
+                            (queries matching any -iq string or regex are included)
 
 --date=[<|>|-]date_first[-][date_last] Include only queries between date_first (and date_last).
                                        Input:                    Date Range:
@@ -96,18 +144,89 @@ Options:
                                        -13.11.2006            -> earlier    - 14.11.2006 (exclusive)
                                        Please do not forget to escape the greater or lesser than symbols (><, i.e. "--date=>13.11.2006").
                                        Short dates are supported if you include a trailing separator (i.e. 13.11.-11/15/).
+                                       Uncompressed log files are time ordered, so the first entry of the range is found
+                                       by a binary search of the "# Time:" lines and reading stops after the range.
+--time-index Keep the "# Time:" offsets found by the --date binary search in mysql_filter_slow_log.sqlite3,
+             so that later searches of the same files read only a few lines
+
+--follow Read new entries of the input file continuously like tail -f -n 0 and continue after log rotation.
+         Use Ctrl+C or kill -INT to stop. With --incremental the first run starts at the end of the file,
+         later runs continue at the last checkpoint.
+--flush-interval=seconds Print the --no-duplicates statistics of the last interval and save the --incremental
+                         statistics and input file position with --follow every seconds [default: 60]
+--daemon=socket Follow all input files like --follow, one thread each, keep the --no-duplicates statistics of all
+                their new entries in memory and answer report requests on the Unix socket without reading the logs
+                again. A request is one line of --sort, --top, --format and query filter (-iq, -eq,
+                --include-query, --exclude-query, --include-query-regex) options and is answered with the report
+                of the matching unique queries; the options of the daemon are the defaults.
+                A file which failed to be followed is reopened at its last saved position, until then the
+                answers start with a WARNING line about it.
+                Implies --incremental: the statistics and input file positions are saved every --flush-interval
+                seconds and a restarted daemon continues there (its older statistics: --report-from-db).
+                Use Ctrl+C or kill -INT to stop, no report is printed then.
+--query-daemon=socket Send all other options as report request to the --daemon listening on socket and print the answer
 
 --incremental Remember input file positions and optionally --no-duplicates statistics between executions in mysql_filter_slow_log.sqlite3
+--checkpoint-interval=seconds Save the input file positions, the --incremental statistics and the unique queries
+                              collected so far together every seconds while reading with --incremental --no-duplicates,
+                              so that an interrupted run continues at its last checkpoint and still reports all
+                              unique queries. Files are read in parts of 64 MB, compressed files as a whole.
+                              0 disables checkpoints [default: 60]
 
 --no-duplicates Output only unique query strings with additional statistics:
                 Execution count, first and last timestamp.
-                Query time: avg / max / sum.
+                Query time: avg / max / sum and the percentiles 50% / 95% / 99%
+                            (estimated with a relative error of at most 1%).
                 Lock time: avg / max / sum.
                 Rows examined: avg / max / sum.
                 Rows sent: avg / max / sum.
 
+--fingerprint Group --no-duplicates queries by their fingerprint: literals are replaced by ?,
+              IN lists, the rows of VALUES lists and whitespace are collapsed, the whitespace around operators
+              is removed and keywords (outside `quoted` identifiers) lowercased (i.e. "select * from t where
+              id in (?+) and a=?"). The first query of each group is printed.
+
+--max-groups=N Keep the --no-duplicates statistics of at most N unique queries (Space-Saving), so that the memory
+               use is bounded regardless of the number of unique queries. A new query replaces the one with the
+               lowest sum query time (or execution count, if sorted by it first) plus error and takes that as
+               its error: the printed statistics only count the executions since the query was last added and
+               its sum query time (execution count) may be up to the error higher. Every query with more
+               than 1/N of the total sum query time (execution count) is reported.
+
 --no-output Do not print statistics, just update database with incremental statistics
 
+--bucket=size Print the execution count, sum and maximum of the query time of each --no-duplicates
+              query per time bucket of size, i.e. 1m, 15m, 1h, 6h or 1d (local days), to see when
+              it became slow. --report-from-db supports hourly and daily buckets.
+--format=text|ndjson|csv|msgpack Print the queries or the --no-duplicates statistics as text (default), or
+                  write one record per query as JSON object per line, CSV with a header line or
+                  MessagePack map (needs the Python msgpack module). Numbers are not formatted.
+                  Query fields: time, unixtime, source, user, host, query_time, lock_time, rows_sent,
+                                rows_examined, query
+                  Statistics fields: query, fingerprint, execution_count, avg/max/sum_query_time,
+                                     avg/max/sum_lock_time, avg/max/sum_rows_sent,
+                                     avg/max/sum_rows_examined, p50/p95/p99_query_time,
+                                     min_timestamp, max_timestamp, users, sources and
+                                     buckets ([bucket start, count, sum, max], not for CSV)
+                  With --bucket, CSV has one bucket,query,execution_count,sum_query_time,max_query_time
+                  row per bucket instead.
+
+--report-from-db Print the --no-duplicates statistics of all --incremental runs from the hourly and
+                 daily totals in mysql_filter_slow_log.sqlite3 without reading any log
+                 (or after reading it with --incremental). --date, --sort and --top are supported.
+
+--jobs=N Parse the input files with N processes in parallel (not available for STDIN).
+         Uncompressed files are split into N parts, compressed files are parsed one per process.
+
+--max-query-bytes=N Cut queries longer than N bytes and append their full size and MD5 digest,
+                    so that different long queries (i.e. huge INSERT batches) still stay unique
+
+--stats Print the wall and CPU time of each phase (reading and parsing, timestamps, filters,
+        aggregation, database, output), the lines read, bytes skipped by --date, entries seen,
+        entries rejected by each filter, unique queries, database rows written and the peak memory to STDERR at exit.
+        With --jobs the phase times are the sums of all processes.
+--profile=file Run with cProfile and save the statistics to file (i.e. for python -m pstats file)
+
 Default ordering of unique queries:
 --sort-sum-query-time    [ 1. position]
 --sort-avg-query-time    [ 2. position]
@@ -122,13 +241,18 @@ Default ordering of unique queries:
 --sort-sum-rows-sent     [11. position]
 --sort-avg-rows-sent     [12. position]
 --sort-max-rows-sent     [13. position]
+--sort-p50-query-time, --sort-p95-query-time, --sort-p99-query-time (only if passed)
 
 --sort=sum-query-time,avg-query-time,max-query-time,...   You can include multiple sorting values separated by commas.
 --sort=sqt,aqt,mqt,slt,alt,mlt,sre,are,mre,ec,srs,ars,mrs Every long sorting option has an equivalent short form (first character of each word).
+--sort=p50qt,p95qt,p99qt                                  The percentiles keep their number.
 
 --top=max_unique_query_count Output maximal max_unique_query_count different unique queries
 --details                    Enables output of timestamp based unique query time lines after user list
                              (i.e. # Query_time: 81  Lock_time: 0  Rows_sent: 884  Rows_examined: 2448350).
+--details=K                  Output the K slowest executions of each unique query and a random sample of K of
+                             all its executions with their user instead, only these are kept while reading.
+                             The sample is picked by a hash of each execution, so it is the same with --jobs.
 
 
 --help Output this message only and quit
@@ -139,16 +263,22 @@ Default ordering of unique queries:
            Remaining default ordering options will keep their relative positions.
 """
 
+import array
+import bisect
+import calendar
+import datetime
+import glob
+import hashlib
+import heapq
+import itertools
 import locale
+import math
 import os
 import re
+import stat
 import sys
 import time
 
-
-# http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/52560
-locale.setlocale(locale.LC_NUMERIC,
-                 os.name == 'nt' and 'en' or 'en_US.ISO8859-1')
 def array_unique(seq):
     """Return a unique list of the sequence elements."""
 
@@ -163,47 +293,591 @@ def number_format(num, places=0):
     return locale.format("%.*f", (places, num), True)
 
 
+def keep_largest(heap, item):
+    """Add item to the heap of the detail_count largest items."""
+
+    if len(heap) < detail_count:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+def execution_hash(user_host, t, query_time):
+    """Return a pseudo-random 60-bit integer of one query execution, which
+    is the same in every run."""
+
+    return int(hashlib.md5('%r %s %r' % (t, user_host, query_time))
+               .hexdigest()[:15], 16)
+
 def cmp_query_times(a, b):
-    """Compare two query executions by Query_time, Lock_time, Rows_examined."""
+    """Compare two query executions by Query_time, Lock_time, Rows_examined, Rows_sent."""
 
-    for i in (0,1,3):
+    for i in (0,1,3,2):
         if a[i] != b[i]:
             return -1 * cmp(a[i], b[i])
     return 0
 
-def cmp_queries(a, b):
-    """Compare two queries by the ordering defined in new_sorting."""
+def query_sort_key(item):
+    """Return the sort key of a (query, data) item by the ordering defined in
+    new_sorting: all values descending, then the query ascending."""
 
-    for i in new_sorting:
-        if a[1][i] != b[1][i]:
-            return -1 * cmp(a[1][i], b[1][i])
-    return 0
+    data = item[1]
+    return tuple([-data[i] for i in new_sorting]) + (item[0],)
 
 def cmp_users(a, b):
     """Compare two users lexicographically."""
 
     return cmp(a[0], b[0])
 
-def process_query(queries, query, no_duplicates, user, host, timestamp,
-                  query_time, ls):
-    """Print or save query for later printing."""
+def sketch_add(sketch, value, count=1):
+    """Add value to the sketch, a dict of bucket index: count.
 
-    user_host = user + ' @ ' + host
-    if no_duplicates:
-        if not queries.has_key(query):
-            queries[query] = {}
-        if not queries[query].has_key(user_host):
-            queries[query][user_host] = {timestamp: query_time}
+    Like DDSketch, the buckets grow exponentially by sketch_gamma, so every
+    quantile is estimated with a relative error of at most sketch_accuracy,
+    however many values were added, and sketches are merged by adding their
+    counts. Zero is counted in the bucket None.
+    """
+
+    if value in sketch_indexes:
+        index = sketch_indexes[value]
+    else:
+        index = None
+        if value > 0:
+            index = int(math.ceil(math.log(value) / sketch_log_gamma))
+        sketch_indexes[value] = index
+    sketch[index] = sketch.get(index, 0) + count
+
+def sketch_merge(sketch, other):
+    """Add all counts of the sketch other to sketch."""
+
+    for index, count in other.iteritems():
+        sketch[index] = sketch.get(index, 0) + count
+
+def sketch_quantiles(sketch, quantiles):
+    """Return the estimated values of the ascending quantiles of sketch."""
+
+    total = sum(sketch.itervalues())
+    values = []
+    seen = 0
+    indexes = iter(sorted(sketch))
+    for quantile in quantiles:
+        rank = quantile * (total - 1)
+        while seen <= rank:
+            index = indexes.next()
+            seen += sketch[index]
+        if index is None:
+            values.append(0.0)
+        else:
+            values.append(2 * sketch_gamma ** index / (sketch_gamma + 1))
+    return values
+
+def dump_sketch(sketch):
+    """Return sketch as string for the database."""
+
+    return ' '.join(['%s:%d' % (index, count)
+                     for index, count in sketch.iteritems()])
+
+def load_sketch(text):
+    """Return the sketch of a dump_sketch() string."""
+
+    sketch = {}
+    for bucket in text.split():
+        index, count = bucket.split(':')
+        if index == 'None':
+            sketch[None] = int(count)
+        else:
+            sketch[int(index)] = int(count)
+    return sketch
+
+def get_bucket(t):
+    """Return the number of the --bucket time bucket of the unix timestamp t.
+
+    Days are counted in local time, so they start at midnight also with DST.
+    """
+
+    if bucket_size < 86400:
+        return int(t) // bucket_size
+    hour = int(t) - int(t) % 3600
+    if hour not in bucket_cache:
+        bucket_cache[hour] = datetime.date.fromtimestamp(hour).toordinal()
+    return bucket_cache[hour]
+
+def get_bucket_start(bucket):
+    """Return the unix timestamp of the start of the time bucket."""
+
+    if bucket_size < 86400:
+        return bucket * bucket_size
+    return time.mktime(datetime.date.fromordinal(bucket).timetuple())
+
+def parse_bucket_size(size):
+    """Return the seconds of a --bucket size like 5m, 1h or 1d or 0."""
+
+    units = {'m': 60, 'h': 3600}
+    if size == '1d':
+        return 86400
+    if size[:-1].isdigit() and size[-1:] in units:
+        return int(size[:-1]) * units[size[-1]]
+    return 0
+
+class BucketSeries(object):
+    """Execution count, query time sum and maximum of one unique query per
+    --bucket time bucket.
+
+    Only the buckets with executions are kept, in parallel arrays sorted by
+    the bucket number, so every such bucket takes 32 bytes however far apart
+    the executions are. Buckets of logs in time order are appended.
+    """
+
+    __slots__ = ('buckets', 'counts', 'sums', 'maxs')
+
+    def __init__(self):
+        self.buckets = array.array('l')
+        self.counts = array.array('l')
+        self.sums = array.array('l')
+        self.maxs = array.array('l')
+
+    def add(self, bucket, count, sum_query_time, max_query_time):
+        """Add count executions in bucket."""
+
+        buckets = self.buckets
+        if buckets and buckets[-1] == bucket:
+            i = len(buckets) - 1
+        elif not buckets or buckets[-1] < bucket:
+            buckets.append(bucket)
+            self.counts.append(count)
+            self.sums.append(sum_query_time)
+            self.maxs.append(max_query_time)
+            return
         else:
-            queries[query][user_host][timestamp] = query_time
+            # Only possible for logs which are not in time order
+            i = bisect.bisect_left(buckets, bucket)
+            if buckets[i] != bucket:
+                buckets.insert(i, bucket)
+                self.counts.insert(i, count)
+                self.sums.insert(i, sum_query_time)
+                self.maxs.insert(i, max_query_time)
+                return
+        self.counts[i] += count
+        self.sums[i] += sum_query_time
+        if max_query_time > self.maxs[i]:
+            self.maxs[i] = max_query_time
+
+    def merge(self, other):
+        """Add all buckets of other."""
+
+        if not other.buckets:
+            return
+        if not self.buckets or self.buckets[-1] <= other.buckets[0]:
+            # i.e. the series of consecutive --jobs byte ranges
+            self.add(other.buckets[0], other.counts[0], other.sums[0],
+                     other.maxs[0])
+            self.buckets.extend(other.buckets[1:])
+            self.counts.extend(other.counts[1:])
+            self.sums.extend(other.sums[1:])
+            self.maxs.extend(other.maxs[1:])
+            return
+        merged = BucketSeries()
+        rows = heapq.merge(self.rows(), other.rows())
+        for bucket, count, sum_query_time, max_query_time in rows:
+            merged.add(bucket, count, sum_query_time, max_query_time)
+        self.buckets, self.counts, self.sums, self.maxs =\
+            merged.buckets, merged.counts, merged.sums, merged.maxs
+
+    def rows(self):
+        """Yield (bucket, count, sum, max) of all buckets with executions."""
+
+        return itertools.izip(self.buckets, self.counts, self.sums, self.maxs)
+
+class ExecutionSample(object):
+    """The --details=K executions of one unique query.
+
+    worst is a heap of the ((Query_time, Lock_time, Rows_examined,
+    Rows_sent), user_host) pairs of the K worst executions, sample a heap of
+    the (-hash, user_host, query_time) of the K executions of the lowest
+    execution_hash() (bottom-K), a uniform sample of all seen executions.
+    Both are the same for any order in which the executions are added or
+    merged, i.e. for --jobs byte ranges.
+    """
+
+    __slots__ = ('seen', 'worst', 'sample')
+
+    def __init__(self):
+        self.seen = 0
+        self.worst = []
+        self.sample = []
+
+    def add(self, user_host, t, query_time):
+        """Add one execution at the timestamp t."""
+
+        self.seen += 1
+        key = (query_time[0], query_time[1], query_time[3], query_time[2])
+        keep_largest(self.worst, (key, user_host))
+        keep_largest(self.sample, (-execution_hash(user_host, t, query_time),
+                                   user_host, query_time))
+
+    def merge(self, other):
+        """Add all executions of other."""
+
+        for item in other.worst:
+            keep_largest(self.worst, item)
+        for item in other.sample:
+            keep_largest(self.sample, item)
+        self.seen += other.seen
+
+class QueryStats(object):
+    """Running statistics of all executions of one unique query.
+
+    users maps each user@host to the set of its distinct query times if
+    --details is set, otherwise to None. sources maps the source of each
+    input file to its execution count, if the sources are tagged.
+    query_time_sketch estimates the query time percentiles. buckets is the
+    BucketSeries of the executions if --bucket is set, executions their
+    ExecutionSample if --details=K is set.
+    """
+
+    __slots__ = ('users', 'sources', 'execution_count', 'min_timestamp',
+                 'max_timestamp', 'sum_query_time', 'min_query_time',
+                 'max_query_time', 'query_time_sketch', 'buckets', 'executions',
+                 'sum_lock_time', 'max_lock_time', 'sum_rows_sent',
+                 'max_rows_sent', 'sum_rows_examined', 'max_rows_examined')
+
+    def __init__(self):
+        self.users = {}
+        self.sources = {}
+        self.execution_count = 0
+        self.max_timestamp = 0.0
+        self.min_timestamp = 2147483647.0 # MAX_INT
+        self.sum_query_time = self.max_query_time = 0
+        self.min_query_time = 2147483647 # MAX_INT
+        self.query_time_sketch = {}
+        self.buckets = None
+        self.executions = None
+        self.sum_lock_time = self.max_lock_time = 0
+        self.sum_rows_sent = self.max_rows_sent = 0
+        self.sum_rows_examined = self.max_rows_examined = 0
+
+    def add(self, user_host, t, query_time, source=None):
+        """Add one execution of the query."""
+
+        if details:
+            if user_host in self.users:
+                self.users[user_host].add(query_time)
+            else:
+                self.users[user_host] = set([query_time])
+        elif user_host not in self.users:
+            self.users[user_host] = None
+        if detail_count:
+            if self.executions is None:
+                self.executions = ExecutionSample()
+            self.executions.add(user_host, t, query_time)
+        if source is not None:
+            self.sources[source] = self.sources.get(source, 0) + 1
+
+        self.execution_count += 1
+        if t < self.min_timestamp:
+            self.min_timestamp = t
+        if t > self.max_timestamp:
+            self.max_timestamp = t
+        query_time, lock_time, rows_sent, rows_examined = query_time
+        self.sum_query_time += query_time
+        if query_time < self.min_query_time:
+            self.min_query_time = query_time
+        if query_time > self.max_query_time:
+            self.max_query_time = query_time
+        sketch_add(self.query_time_sketch, query_time)
+        if bucket_size:
+            bucket = get_bucket(t)
+            if self.buckets is None:
+                self.buckets = BucketSeries()
+            self.buckets.add(bucket, 1, query_time, query_time)
+        self.sum_lock_time += lock_time
+        if lock_time > self.max_lock_time:
+            self.max_lock_time = lock_time
+        self.sum_rows_sent += rows_sent
+        if rows_sent > self.max_rows_sent:
+            self.max_rows_sent = rows_sent
+        self.sum_rows_examined += rows_examined
+        if rows_examined > self.max_rows_examined:
+            self.max_rows_examined = rows_examined
+
+    def merge(self, other):
+        """Add all executions of other."""
+
+        for user_host, query_times in other.users.iteritems():
+            if query_times is not None and user_host in self.users:
+                self.users[user_host].update(query_times)
+            else:
+                self.users[user_host] = query_times
+        for source, execution_count in other.sources.iteritems():
+            self.sources[source] = self.sources.get(source, 0) + execution_count
+
+        self.execution_count += other.execution_count
+        self.min_timestamp = min(self.min_timestamp, other.min_timestamp)
+        self.max_timestamp = max(self.max_timestamp, other.max_timestamp)
+        self.sum_query_time += other.sum_query_time
+        self.min_query_time = min(self.min_query_time, other.min_query_time)
+        self.max_query_time = max(self.max_query_time, other.max_query_time)
+        sketch_merge(self.query_time_sketch, other.query_time_sketch)
+        if other.buckets is None:
+            pass
+        elif self.buckets is None:
+            self.buckets = other.buckets
+        else:
+            self.buckets.merge(other.buckets)
+        if other.executions is None:
+            pass
+        elif self.executions is None:
+            self.executions = other.executions
+        else:
+            self.executions.merge(other.executions)
+        self.sum_lock_time += other.sum_lock_time
+        self.max_lock_time = max(self.max_lock_time, other.max_lock_time)
+        self.sum_rows_sent += other.sum_rows_sent
+        self.max_rows_sent = max(self.max_rows_sent, other.max_rows_sent)
+        self.sum_rows_examined += other.sum_rows_examined
+        self.max_rows_examined = max(self.max_rows_examined,
+                                     other.max_rows_examined)
+
+class Aggregator(object):
+    """The --no-duplicates statistics of a stream of entries.
+
+    queries maps each unique query (with --fingerprint the hash of its
+    fingerprint) to its QueryStats, samples each fingerprint hash to
+    (fingerprint, first query, (timestamp, file index, offset) of it), where
+    origin is the (file index, offset) of the first added entry. merge()
+    keeps the earliest sample, like reading all entries in one process. With
+    --incremental the stats rows of all added entries are collected in
+    db_rows until write_stats() saves them.
+
+    With --max-groups at most max_groups queries are kept (Space-Saving).
+    A new query replaces the one of the lowest weight and errors maps it to
+    that weight, by which its own weight may be too low. heap holds the
+    (weight, query) pairs of all queries, their weights may be outdated.
+    """
+
+    def __init__(self):
+        self.queries = {}
+        self.samples = {}
+        self.origin = (0, 0)
+        self.db_rows = []
+        self.errors = {}
+        self.heap = None
+
+    def add(self, entry, source=None):
+        """Add one (query, user, host, timestamp, t, query_time) entry."""
+
+        query, user, host, timestamp, t, query_time = entry
+        if fingerprint:
+            text = fingerprint_query(query)
+            key = hashlib.md5(text).digest()[:8]
+            if not self.samples.has_key(key):
+                self.samples[key] = (text, query, (t,) + self.origin)
+            if incremental:
+                self.db_rows.append((text, user, host, t) + query_time)
+            query = key
+        elif incremental:
+            self.db_rows.append((query, user, host, t) + query_time)
+        queries = self.queries
+        if query in queries:
+            queries[query].add(user + ' @ ' + host, t, query_time, source)
+        else:
+            error = 0
+            if max_groups and len(queries) >= max_groups:
+                error = self.evict()
+            stats = queries[query] = QueryStats()
+            stats.add(user + ' @ ' + host, t, query_time, source)
+            if error:
+                self.errors[query] = error
+            if self.heap is not None:
+                heapq.heappush(self.heap, (self.weight(query), query))
+
+    def weight(self, query):
+        """Return the --max-groups weight of query including its error."""
+
+        return getattr(self.queries[query], max_groups_weight) +\
+               self.errors.get(query, 0)
+
+    def evict(self):
+        """Remove the query of the lowest weight and return its weight."""
+
+        heap = self.heap
+        if heap is None:
+            heap = self.heap = [(self.weight(query), query)
+                                for query in self.queries]
+            heapq.heapify(heap)
+        while True:
+            weight, query = heap[0]
+            current = self.weight(query)
+            if current == weight:
+                break
+            heapq.heapreplace(heap, (current, query))
+        heapq.heappop(heap)
+        del self.queries[query]
+        self.samples.pop(query, None)
+        self.errors.pop(query, None)
+        return weight
+
+    def merge_samples(self, other):
+        """Keep the earliest sample of each fingerprint of both."""
+
+        samples = self.samples
+        for key, sample in other.samples.iteritems():
+            if key not in samples or sample[2] < samples[key][2]:
+                samples[key] = sample
+
+    def merge(self, other):
+        """Add all statistics of other."""
+
+        queries = self.queries
+        if max_groups:
+            # A query missing on one side may have had up to the lowest
+            # weight there, if that side was full
+            floors = [len(side.queries) >= max_groups and
+                      min([side.weight(query) for query in side.queries]) or 0
+                      for side in (self, other)]
+            for query in floors[1] and queries or ():
+                if query not in other.queries:
+                    self.errors[query] = self.errors.get(query, 0) + floors[1]
+            for query in other.queries:
+                error = other.errors.get(query, 0)
+                if query not in queries:
+                    error += floors[0]
+                if error:
+                    self.errors[query] = self.errors.get(query, 0) + error
+        for query, stats in other.queries.iteritems():
+            if query in queries:
+                queries[query].merge(stats)
+            else:
+                queries[query] = stats
+        self.merge_samples(other)
+        self.db_rows.extend(other.db_rows)
+        self.heap = None
+        if max_groups and len(queries) > max_groups:
+            kept = dict.fromkeys(heapq.nlargest(max_groups, queries,
+                                                self.weight))
+            for query in queries.keys():
+                if query not in kept:
+                    del queries[query]
+                    self.samples.pop(query, None)
+                    self.errors.pop(query, None)
+
+    def clear(self):
+        """Forget all statistics, i.e. after each --flush-interval."""
+
+        self.queries.clear()
+        self.samples.clear()
+        self.errors.clear()
+        self.heap = None
+
+    def report(self):
+        """Print or write the statistics of the unique queries in --format."""
+
+        if run_stats is not None:
+            run_stats.count('unique queries', len(self.queries))
+        if self.queries:
+            output_report(self)
+
+def output_entry(entry, source=None):
+    """Print or write one entry in --format."""
+
+    query, user, host, timestamp, t, query_time = entry
+    if record_writer is not None:
+        record_writer.add([timestamp, t, source, user, host] +
+                          list(query_time) + [query])
     else:
-        print '# Time: %s%s# User@Host: %s%s# Query_time: %d  Lock_time: %d  '\
+        if source is not None:
+            timestamp += '%s# Source: %s' % (ls, source)
+        print '# Time: %s%s# User@Host: %s @ %s%s# Query_time: %d  Lock_time: %d  '\
               'Rows_sent: %d  Rows_examined: %d%s%s%s' % (timestamp, ls,
-              user_host, ls, query_time[0], query_time[1], query_time[2],
+              user, host, ls, query_time[0], query_time[1], query_time[2],
               query_time[3], ls, query, ls),
 
+def fingerprint_token(match):
+    """Return the normalized replacement of one fingerprint_regex match."""
+
+    group = match.lastindex
+    if group == 7: # word
+        word = match.group(7)
+        if word.upper() in sql_keywords:
+            return word.lower()
+        return word
+    elif group == 6: # whitespace
+        return ' '
+    elif group == 5: # operator without the whitespace around it
+        return match.group(5).strip()
+    elif group == 8: # identifier, case sensitive on most systems
+        return match.group(8)
+    elif group == 1: # IN list
+        return 'in (?+)'
+    elif group == 4: # comment
+        return ' '
+    elif group == 3 and match.group(3)[0] == '-' and binary_minus(match):
+        return '-?'
+    return '?' # string or number
+
+def binary_minus(match):
+    """Return whether the - of a number match subtracts it from the operand
+    before it (a-5), rather than being its sign (a=-5, in -5, (-5))."""
+
+    query = match.string
+    i = match.start() - 1
+    while i >= 0 and query[i].isspace():
+        i -= 1
+    if i < 0:
+        return False
+    if query[i] in ')`\'"':
+        return True
+    if not (query[i].isalnum() or query[i] in '_$'):
+        return False
+    end = i + 1
+    while i >= 0 and (query[i].isalnum() or query[i] in '_$'):
+        i -= 1
+    return query[i+1:end].upper() not in sql_keywords
+
+def fingerprint_query(query):
+    """Return the query with literals (including their sign) replaced by ?,
+    collapsed IN lists, multi-row VALUES lists and whitespace, no whitespace
+    around operators and lowercased keywords (but not in `quoted`
+    identifiers)."""
+
+    text = fingerprint_regex.sub(fingerprint_token, query).strip()
+    if 'value' in text:
+        text = fingerprint_values_regex.sub(r'\1 \2', text)
+    return text
+
 def get_log_timestamp(t):
-    return time.mktime(time.strptime(t, '%y%m%d %H:%M:%S'))
+    """Return the unix timestamp of a slow log "# Time:" value.
+
+    Supports the local time layout "070119 12:29:58" and the ISO 8601 layout
+    "2007-01-19T12:29:58.123456Z" (or with a "+01:00" UTC offset) of MySQL
+    5.6+. The epoch of each hour is cached, so only the minutes and seconds
+    have to be converted for all further timestamps of the same hour.
+    """
+
+    if t[4] == '-': # 2007-01-19T12:29:58.123456Z
+        key = t[:13]
+        if key not in timestamp_cache:
+            timestamp_cache[key] = calendar.timegm((int(t[:4]), int(t[5:7]),
+                int(t[8:10]), int(t[11:13]), 0, 0, 0, 0, 0))
+        end = len(t)
+        offset = 0
+        if t[-1] == 'Z':
+            end -= 1
+        elif t[-6] in '+-':
+            end -= 6
+            offset = int(t[-5:-3]) * 3600 + int(t[-2:]) * 60
+            if t[-6] == '-':
+                offset = -offset
+        return timestamp_cache[key] + int(t[14:16]) * 60 + float(t[17:end])\
+               - offset
+
+    # 070119 12:29:58 (the hour may be padded with a space)
+    key = t[:9]
+    if key not in timestamp_cache:
+        year = int(t[:2])
+        year += year < 69 and 2000 or 1900
+        timestamp_cache[key] = time.mktime((year, int(t[2:4]), int(t[4:6]),
+                                            int(t[7:9]), 0, 0, 0, 0, -1))
+    return timestamp_cache[key] + int(t[10:12]) * 60 + int(t[13:15])
 
 def parse_date_range(date):
     """
@@ -287,307 +961,920 @@ def parse_time(date):
 
     return False
 
+def trie_pattern(node):
+    """Return the regular expression of one node of the trie_regex() trie."""
 
-infile = None
-min_query_time = 1
-min_rows_examined = 0
-include_hosts = []
-exclude_hosts = []
-include_users = []
-exclude_users = []
-include_queries = []
-no_duplicates = False
-no_output = False
-details = False
-date_first = False
-date_last = False
-ls = os.linesep
-date_format = '%Y-%m-%d %H:%M:%S'
-default_sorting = [4, 'sum-query-time', 2, 'avg-query-time', 3, 'max-query-time',
-                   7, 'sum-lock-time', 5, 'avg-lock-time', 6, 'max-lock-time',
-                   13, 'sum-rows-examined', 11, 'avg-rows-examined',
-                   12, 'max-rows-examined', 1, 'execution-count',
-                   10, 'sum-rows-sent', 8, 'avg-rows-sent', 9, 'max-rows-sent']
-first_chars = lambda words: ''.join([word[0] for word in words])
-# TODO: Is there an easier way to extend with each of the two value pairs?
-for t in [[default_sorting[i], first_chars(default_sorting[i+1].split('-'))]
-    for i in range(0, len(default_sorting), 2)]:
-  default_sorting.extend(t)
-new_sorting = []
-top = 0
-incremental = False
+    if '' in node:
+        return '' # Longer words contain this one anyway
+    alternatives = [re.escape(c) + trie_pattern(node[c]) for c in sorted(node)]
+    if len(alternatives) == 1:
+        return alternatives[0]
+    return '(?:%s)' % '|'.join(alternatives)
+
+def trie_regex(words):
+    """Return a regular expression matching any of the words.
+
+    The words are factored into a trie of common prefixes, so the regular
+    expression engine never tries more than one alternative per character,
+    however many words there are.
+    """
+
+    trie = {}
+    for word in words:
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[''] = True
+    return trie_pattern(trie)
+
+def compile_filter(strings, regexes=()):
+    """Return the search method of one regular expression matching any of the
+    strings or regexes, or None if there are none."""
 
-# Decode all parameters to Unicode before parsing
-fs_encoding = sys.getfilesystemencoding()
-sys.argv = [s.decode(fs_encoding) for s in sys.argv]
+    patterns = list(regexes)
+    if strings:
+        patterns.insert(0, trie_regex(strings))
+    if not patterns:
+        return None
+    return re.compile('|'.join(['(?:%s)' % p for p in patterns])).search
+
+def is_included_user(user, host):
+    """Return whether user and host pass the include and exclude filters."""
+
+    if include_host_search:
+        if not include_host_search(host):
+            return False
+    elif exclude_host_search and exclude_host_search(host):
+        return False
+
+    if include_user_search:
+        if not include_user_search(user):
+            return False
+    elif exclude_user_search and exclude_user_search(user):
+        return False
+    return True
+
+def is_included_query(query):
+    """Return whether query passes the include and exclude query filters."""
+
+    if exclude_query_search and exclude_query_search(query):
+        return False
+    if include_query_search:
+        return include_query_search(query) is not None
+    return True
+
+def parse_query_time(numbers):
+    """Return (Query_time, Lock_time, Rows_sent, Rows_examined)."""
+
+    numbers = numbers.split(':')
+    return (int(numbers[1].split()[0]), int(numbers[2].split()[0]),
+            int(numbers[3].split()[0]), int(numbers[4]))
+
+def is_slow_query(query_time):
+    """Return whether query_time passes the -T and -R minimum filters."""
+
+    return query_time[0] >= min_query_time or (min_rows_examined
+           and query_time[3] >= min_rows_examined)
+
+def is_excluded_time(t):
+    """Return whether the unix timestamp t is outside of the --date range."""
+
+    return date_first and t < date_first or date_last and t > date_last
+
+def limit_query(query, size, digest=None):
+    """Return query, cut to max_query_bytes and marked with its full size and
+    MD5 digest if the complete query was larger."""
+
+    if max_query_bytes and size > max_query_bytes:
+        if digest is None:
+            digest = hashlib.md5(query)
+        return '%s... /* %d bytes, md5 %s */' % (query[:max_query_bytes],
+                                                size, digest.hexdigest())
+    return query
+
+def pass_all(*args):
+    """Return True, the filter of unfiltered entries."""
+
+    return True
+
+def pass_none(*args):
+    """Return False, the exclude filter of unfiltered entries."""
+
+    return False
+
+def parse_entries(lines, filtered=True, timestamps=None):
+    """Yield (query, user, host, timestamp, t, query_time) of all filtered
+    queries (or all queries unless filtered). t is only parsed if timestamps
+    (by default parse_timestamps of the options) is set, otherwise None."""
+
+    included_user, slow_query, included_query, excluded_time = filtered and\
+        (is_included_user, is_slow_query, is_included_query, is_excluded_time) or\
+        (pass_all, pass_all, pass_all, pass_none)
+    if timestamps is None:
+        timestamps = parse_timestamps
+    if run_stats is not None:
+        lines = run_stats.count_lines(lines)
+    in_query = False
+    # Query body lines are collected and joined once per entry
+    pieces = []
+    size = 0
+    digest = None
+    timestamp = ''
+    t = None
+    user = host = ''
+    query_time = []
+    for line in lines:
+        if not line: continue
+        if line[-1] != '\n':
+            line += '\n' # Last line of a file, as parse_buffer() reads it
+        if line[0] == '#' and line[1] == ' ':
+            if size:
+                query = limit_query(''.join(pieces), size, digest)
+                # Entries without Query_time line are incomplete
+                if in_query and query_time and included_query(query):
+                    yield (query, user, host, timestamp, t, query_time)
+                pieces = []
+                size = 0
+                digest = None
+                in_query = False
+
+            if line[2] == 'T':  # # Time: 070119 12:29:58
+                timestamp = line[8:-1]
+                if timestamps:
+                    t = get_log_timestamp(timestamp)
+                    if excluded_time(t):
+                        timestamp = False
+            elif line[2] == 'U' and timestamp: # # User@Host: root[root] @ localhost []
+                user, host = line[13:-1].split(' @ ', 2)
+                in_query = included_user(user, host)
+                query_time = []
+            # # Query_time: 0  Lock_time: 0  Rows_sent: 0  Rows_examined: 156
+            elif in_query and line[2] == 'Q':
+                query_time = parse_query_time(line[12:-1])
+                in_query = slow_query(query_time)
+            elif line == follow_reset: # The followed file was rotated
+                in_query = False
+                query_time = []
+
+        elif in_query:
+            line = line[:-1]
+            size += len(line)
+            if digest is not None:
+                digest.update(line)
+                continue
+            pieces.append(line)
+            if max_query_bytes and size > max_query_bytes:
+                # Keep only max_query_bytes of the query but hash all of it
+                pieces = [''.join(pieces)]
+                digest = hashlib.md5(pieces[0])
+
+    if size:
+        query = limit_query(''.join(pieces), size, digest)
+        if in_query and query_time and included_query(query):
+            yield (query, user, host, timestamp, t, query_time)
+
+def parse_buffer(buf, start, end, filtered=True, timestamps=None):
+    """Yield (query, user, host, timestamp, t, query_time) of all filtered queries
+    (or all queries unless filtered) between the offsets start and end of buf
+    (i.e. a mmap). t is parsed like in parse_entries().
+
+    Only header fields are sliced out of buf while filtering, query bodies of
+    rejected entries are skipped with find() and never copied.
+    """
+
+    included_user, slow_query, included_query, excluded_time = filtered and\
+        (is_included_user, is_slow_query, is_included_query, is_excluded_time) or\
+        (pass_all, pass_all, pass_all, pass_none)
+    if timestamps is None:
+        timestamps = parse_timestamps
+    if run_stats is not None:
+        run_stats.count_buffer(buf, start, end)
+    in_query = False
+    query = ''
+    timestamp = ''
+    t = None
+    user = host = ''
+    query_time = []
+    pos = start
+    if buf[pos:pos+2] != '# ':
+        # Skip the body of an incomplete leading entry
+        pos = buf.find('\n# ', pos, end)
+        pos = pos < 0 and end or pos + 1
+    while pos < end:
+        # pos is at the beginning of a header line
+        eol = buf.find('\n', pos, end)
+        if eol < 0:
+            eol = end
+        if query:
+            # Entries without Query_time line are incomplete
+            if in_query and query_time and included_query(query):
+                yield (query, user, host, timestamp, t, query_time)
+            query = ''
+            in_query = False
+
+        c = pos + 2 < end and buf[pos+2] or '' # "# " at the end of a file
+        if c == 'T':  # # Time: 070119 12:29:58
+            timestamp = buf[pos+8:eol]
+            if timestamps:
+                t = get_log_timestamp(timestamp)
+                if excluded_time(t):
+                    timestamp = False
+        elif c == 'U' and timestamp: # # User@Host: root[root] @ localhost []
+            user, host = buf[pos+13:eol].split(' @ ', 2)
+            in_query = included_user(user, host)
+            query_time = []
+        # # Query_time: 0  Lock_time: 0  Rows_sent: 0  Rows_examined: 156
+        elif in_query and c == 'Q':
+            query_time = parse_query_time(buf[pos+12:eol])
+            in_query = slow_query(query_time)
+
+        # Query body up to the next header line
+        pos = buf.find('\n# ', eol, end)
+        pos = pos < 0 and end or pos + 1
+        if in_query and eol + 1 < pos:
+            query = buf[eol+1:pos].replace('\n', '')
+            if max_query_bytes:
+                query = limit_query(query, len(query))
+
+    if query and in_query and query_time and included_query(query):
+        yield (query, user, host, timestamp, t, query_time)
+
+# Literals, IN lists, comments, whitespace, quoted identifiers and words in a
+# single pass. Strings and identifiers cut off by --max-query-bytes or a
+# truncated log line end at the end of the query instead of backtracking.
+fingerprint_string = r"""'(?:[^'\\]|\\.|'')*(?:'|\\?$)|"(?:[^"\\]|\\.|"")*(?:"|\\?$)"""
+fingerprint_literal = r"""(?:%s|-?\b\d+(?:\.\d*)?\b|NULL)""" % fingerprint_string
+fingerprint_regex = re.compile(r"""
+    (\b[Ii][Nn]\s*\(\s*%s(?:\s*,\s*%s)*\s*\))                            # IN list
+  | (%s)                                                                 # string
+  | ((?:-\s*)?(?:\b0x[0-9a-fA-F]+\b|(?:\b\d+(?:\.\d*)?|\B\.\d+)(?:[eE][-+]?\d+)?\b))
+                                                                         # number
+  | (\s*/\*.*?\*/\s*)                                                    # comment
+  | (\s*(?:[=<>!]+|[-+/%%|&^~,])\s*)                                     # operator
+  | (\s+)                                                                # whitespace
+  | ([A-Za-z_$][\w$]*)                                                   # word
+  | (`(?:[^`]|``)*(?:`|$))                                               # identifier
+    """ % (fingerprint_literal, fingerprint_literal, fingerprint_string),
+    re.VERBOSE | re.DOTALL)
+# The rows of a fingerprinted VALUES list (with one level of nested
+# parentheses for function calls) are collapsed to the first one
+fingerprint_row = r'\((?:[^()]|\([^()]*\))*\)'
+fingerprint_values_regex = re.compile(r'\b(values?) ?(%s)(?:,%s)*' %
+                                      (fingerprint_row, fingerprint_row))
+compression_magic = [('gzip', '\x1f\x8b'), ('bzip2', 'BZh'),
+                     ('xz', '\xfd7zXZ\x00'), ('zstd', '\x28\xb5\x2f\xfd')]
+# External decompressors in order of preference, the parallel ones first
+decompress_commands = {
+    'gzip': [['pigz', '-dc'], ['gzip', '-dc']],
+    'bzip2': [['pbzip2', '-dc'], ['lbzip2', '-dc'], ['bzip2', '-dc']],
+    'xz': [['xz', '-dc', '-T0']],
+    'zstd': [['zstd', '-dcq']],
+}
+read_size = 1024 * 1024
+sql_keywords = dict.fromkeys('''ALL ALTER AND ANY AS ASC BETWEEN BY CALL CASE CREATE
+    CROSS DATABASE DEFAULT DELAYED DELETE DESC DISTINCT DROP DUPLICATE ELSE END
+    EXISTS EXPLAIN FOR FORCE FROM FULL GROUP HAVING HIGH_PRIORITY IGNORE IN INDEX
+    INNER INSERT INTO IS JOIN KEY LEFT LIKE LIMIT LOCK LOW_PRIORITY MODE NATURAL NOT
+    NULL OFFSET ON OR ORDER OUTER PROCEDURE REGEXP REPLACE RIGHT ROLLUP SELECT SET
+    SHARE SHOW SQL_CALC_FOUND_ROWS SQL_NO_CACHE STRAIGHT_JOIN TABLE THEN TRUNCATE
+    UNION UNIQUE UPDATE USE USING VALUE VALUES WHEN WHERE WITH XOR'''.split())
+
+def map_file(f):
+    """Return a read-only mmap of the regular file f or None."""
 
-# TODO: use optparse
-for arg in sys.argv[1:]:
-    _arg = arg[:3]
     try:
-        if '-T=' == _arg: min_query_time = abs(int(arg[3:]))
-        elif '-R=' == _arg: min_rows_examined = abs(int(arg[3:]))
-        elif '-ih' == _arg: include_hosts.append(arg[4:])
-        elif '-eh' == _arg: exclude_hosts.append(arg[4:])
-        elif '-iu' == _arg: include_users.append(arg[4:])
-        elif '-eu' == _arg: exclude_users.append(arg[4:])
-        elif '-iq' == _arg: include_queries.append(arg[4:])
-        elif '--incremental' == arg: incremental = True
-        elif '--no-duplicates' == arg: no_duplicates = True
-        elif '--no-output' == arg: no_output = True
-        elif '--details' == arg: details = True
-        elif '--sort' == arg[:6] and len(arg) > 9 and arg[6] in '=-':
-            for sorting in arg[7:].split(','):
-                if not sorting.isdigit() and sorting in default_sorting:
-                    i = default_sorting.index(sorting)-1
-                    if default_sorting[i] not in new_sorting:
-                        new_sorting.append(default_sorting[i])
-        elif '--include-user=' == arg[:15]: include_users.append(arg[15:])
-        elif '--exclude-user=' == arg[:15]: exclude_users.append(arg[15:])
-        elif '--include-host=' == arg[:15]: include_hosts.append(arg[15:])
-        elif '--exclude-host=' == arg[:15]: exclude_hosts.append(arg[15:])
-        elif '--include-query=' == arg[:16]: include_queries.append(arg[16:])
-        elif '--top=' == arg[:6]:
-            _top = abs(int(arg[6:]))
-            if _top:
-                top = _top
-        elif '--date=' == arg[:7] and len(arg) > 10:
-            # Do not overwrite already parsed date values
-            if date_first or date_last:
+        import mmap
+        if os.fstat(f.fileno()).st_size:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ImportError, EnvironmentError, ValueError), e:
+        pass
+    return None
+
+def find_entry_start(f, pos):
+    """Return the offset of the first "# Time:" line at or after pos."""
+
+    # Step back one byte so that a line starting exactly at pos is not skipped
+    f.seek(max(pos - 1, 0))
+    if pos:
+        f.readline()
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        if not line or line[:8] == '# Time: ':
+            return offset
+
+def split_byte_ranges(f, start, end, count):
+    """Split f[start:end] into up to count ranges aligned on log entries."""
+
+    size = (end - start) // count
+    offsets = [start]
+    for k in range(1, count):
+        offset = find_entry_start(f, start + k * size)
+        if offset > offsets[-1] and offset < end:
+            offsets.append(offset)
+    offsets.append(end)
+    return [(offsets[k], offsets[k+1]) for k in range(len(offsets) - 1)]
+
+def read_byte_range(f, start, end):
+    """Yield all lines of f starting between the offsets start and end."""
+
+    f.seek(start)
+    while start < end:
+        line = f.readline()
+        if not line:
+            break
+        start += len(line)
+        yield line
+
+def read_time(f, offset):
+    """Return the unix timestamp of the "# Time:" line at offset of f or None."""
+
+    f.seek(offset)
+    line = f.readline()
+    if line[:8] != '# Time: ':
+        return None
+    return get_log_timestamp(line[8:].rstrip())
+
+def find_time_offset(f, start, end, passed, known=()):
+    """Return the offset of the first "# Time:" line between start and end of
+    the time ordered log f whose timestamp passes passed(t) (or end) and the
+    (offset, timestamp) pairs of all "# Time:" lines read on the way.
+
+    The binary search is narrowed first by the known (offset, timestamp)
+    pairs of earlier searches.
+    """
+
+    lo, hi = start, end
+    for offset, t in known:
+        if offset < start or offset >= end:
+            continue
+        if passed(t):
+            hi = min(hi, offset)
+        else:
+            lo = max(lo, offset + 1)
+    probes = []
+    while lo < hi:
+        mid = (lo + hi) // 2
+        offset = find_entry_start(f, mid)
+        if offset >= hi:
+            # No "# Time:" line between mid and hi
+            hi = mid
+            continue
+        t = read_time(f, offset)
+        probes.append((offset, t))
+        if passed(t):
+            hi = mid
+        else:
+            lo = offset + 1 # All earlier entries fail as well
+    return min(find_entry_start(f, lo), end), probes
+
+def get_compression(f):
+    """Return the compression format of f detected by its magic bytes or None.
+
+    The file position is not changed.
+    """
+
+    magic = f.read(6)
+    f.seek(-len(magic), 1)
+    for compression, prefix in compression_magic:
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+def iter_decompressed(f, compression):
+    """Yield the decompressed data of the rest of f in chunks.
+
+    Concatenated streams (i.e. gzip members or pbzip2 output) are all
+    decompressed, one after the other.
+    """
+
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError, e:
+            print >>sys.stderr, "ERROR: Neither the zstd command nor the Python zstandard module is available for %s" % f.name
+            sys.exit()
+        reader = zstandard.ZstdDecompressor().stream_reader(f,
+                     read_size=read_size, read_across_frames=True)
+        while True:
+            chunk = reader.read(read_size)
+            if not chunk:
+                break
+            yield chunk
+        return
+    if compression == 'gzip':
+        import zlib
+        new_decompressor = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'bzip2':
+        import bz2
+        new_decompressor = bz2.BZ2Decompressor
+    else:
+        try:
+            import lzma
+        except ImportError, e:
+            try:
+                from backports import lzma
+            except ImportError, e:
+                print >>sys.stderr, "ERROR: Neither the xz command nor the Python lzma module is available for %s" % f.name
+                sys.exit()
+        new_decompressor = lzma.LZMADecompressor
+
+    decompressor = new_decompressor()
+    while True:
+        data = f.read(read_size)
+        if not data:
+            break
+        while data:
+            try:
+                chunk = decompressor.decompress(data)
+            except EOFError:
+                # The last stream ended exactly with the last read
+                decompressor = new_decompressor()
                 continue
-            date_first, date_last = parse_date_range(arg[7:])
-        elif '--help' == arg:
-            print >>sys.stderr, usage
+            if chunk:
+                yield chunk
+            data = decompressor.unused_data
+            if not data.strip('\0'):
+                break # nothing or padding after the end of the stream
+            decompressor = new_decompressor()
+
+def decompress_lines(f, compression):
+    """Yield the decompressed lines of the rest of the compressed file f.
+
+    If one of the decompress_commands is found in PATH, it decompresses in
+    its own process (pigz, pbzip2 and xz even with several threads) while
+    the lines are parsed. Otherwise f is decompressed in this process.
+    """
+
+    from distutils.spawn import find_executable
+    for args in decompress_commands[compression]:
+        if not find_executable(args[0]):
+            continue
+        import subprocess
+        # The buffered file position is not necessarily the one of the fd
+        os.lseek(f.fileno(), f.tell(), 0)
+        proc = subprocess.Popen(args, stdin=f, stdout=subprocess.PIPE,
+                                bufsize=read_size)
+        for line in proc.stdout:
+            yield line
+        if proc.wait():
+            print >>sys.stderr, "ERROR: %s could not decompress %s" % (args[0], f.name)
             sys.exit()
-        elif not infile and os.path.isfile(arg):
-            infile = open(arg, 'r')
-    except ValueError, e:
-        pass
+        return
+
+    from cStringIO import StringIO
+    rest = ''
+    for chunk in iter_decompressed(f, compression):
+        end = chunk.rfind('\n') + 1
+        if not end:
+            rest += chunk
+            continue
+        for line in StringIO(rest + chunk[:end]):
+            yield line
+        rest = chunk[end:]
+    if rest:
+        yield rest
+
+def iter_entries(f, filtered=False, end=None, timestamps=True):
+    """Yield the (query, user, host, timestamp, t, query_time) entries of the
+    slow log file f one by one, only the filtered ones if filtered is set.
+
+    Regular files are read with mmap and compressed files are decompressed
+    while they are parsed. Any other file or iterable of lines is parsed
+    line by line. Unless timestamps is set, t is None. Uncompressed files
+    are read up to the offset end if it is given.
+    """
 
-if not infile:
     try:
-        sys.stdin.tell()
-        infile = sys.stdin
-    except IOError:
-        print >>sys.stderr, "ERROR: No input data on STDIN available"
-        sys.exit()
+        compression = get_compression(f)
+    except (AttributeError, IOError), e:
+        compression = None # STDIN, a pipe or a list of lines
+    buf = None
+    if compression:
+        for entry in parse_entries(decompress_lines(f, compression), filtered,
+                                   timestamps):
+            yield entry
+        f.seek(0, 2)
+        return
+    if f is not sys.stdin:
+        buf = map_file(f)
+    if buf is None:
+        lines = f
+        if end is not None:
+            lines = read_byte_range(f, f.tell(), end)
+        for entry in parse_entries(lines, filtered, timestamps):
+            yield entry
+        return
+    if end is None or end > len(buf):
+        end = len(buf)
+    try:
+        for entry in parse_buffer(buf, f.tell(), end, filtered, timestamps):
+            yield entry
+        f.seek(end)
+    finally:
+        buf.close()
+
+def filter_dates(entries):
+    """Yield the entries inside of the --date range."""
+
+    for entry in entries:
+        if not is_excluded_time(entry[4]):
+            yield entry
+
+def filter_users(entries):
+    """Yield the entries passing the user and host filters."""
+
+    for entry in entries:
+        if is_included_user(entry[1], entry[2]):
+            yield entry
+
+def filter_query_times(entries):
+    """Yield the entries passing the -T and -R minimum filters."""
+
+    for entry in entries:
+        if is_slow_query(entry[5]):
+            yield entry
 
-include_hosts = array_unique(include_hosts)
-exclude_hosts = array_unique(exclude_hosts)
-include_users = array_unique(include_users)
-exclude_users = array_unique(exclude_users)
-for i in range(0, len(default_sorting)-1, 2):
-    if default_sorting[i] not in new_sorting:
-        new_sorting.append(default_sorting[i])
+def filter_queries(entries):
+    """Yield the entries passing the query filters."""
 
+    for entry in entries:
+        if is_included_query(entry[0]):
+            yield entry
 
-in_query = False
-query = ''
-timestamp = ''
-user = ''
-query_time = []
-queries = {}
-con = None
+filter_stages = [filter_dates, filter_users, filter_query_times, filter_queries]
 
-if incremental:
+def filter_entries(entries, stages=filter_stages):
+    """Return the entries passed through all filter stages.
+
+    filter_entries(iter_entries(f)) yields the same entries as
+    iter_entries(f, True), which filters while parsing.
+    """
+
+    for stage in stages:
+        entries = stage(entries)
+    return entries
+
+def iter_byte_range(name, start, end):
+    """Yield the filtered entries of one byte range of the log file name.
+    An end of None stands for the rest of a compressed file."""
+
+    f = open(name, 'r')
     try:
-        import sqlite3
-    except ImportError, e:
+        buf = end is not None and map_file(f) or None
+        if end is None:
+            f.seek(start)
+            entries = parse_entries(decompress_lines(f, get_compression(f)))
+        elif buf is not None:
+            entries = parse_buffer(buf, start, end)
+        else:
+            entries = parse_entries(read_byte_range(f, start, end))
+        for entry in entries:
+            yield entry
+    finally:
+        f.close()
+
+def parse_byte_range(args):
+    """Parse one byte range of a log file from the given source in a worker
+    process.
+
+    Returns an Aggregator of the entries if no_duplicates is set, otherwise
+    the list of filtered entries in log order, together with the RunStats
+    of the worker (None without --stats). An end of None stands for the rest
+    of a compressed file. None is returned if an ERROR was printed.
+    """
+
+    name, index, start, end, source = args
+    try:
+        if run_stats is not None:
+            run_stats.clear() # of the last byte range of this worker
+            run_stats.start_reading()
+        entries = iter_byte_range(name, start, end)
+        if not no_duplicates:
+            result = list(entries)
+        else:
+            result = Aggregator()
+            result.origin = (index, start)
+            for entry in entries:
+                result.add(entry, source)
+        if run_stats is not None:
+            run_stats.stop_reading()
+        return result, run_stats
+    except SystemExit, e:
+        return None # The pool would wait forever for an exited worker
+
+def range_outcomes(pool, ranges):
+    """Yield each of the byte ranges with its outcome in their order.
+
+    The outcome is the result of parse_byte_range() in a --jobs worker of
+    the pool, of which at most 2 * jobs ranges are parsed ahead, or the lazy
+    entries parsed in this process (and None instead of the RunStats)
+    without pool and for compressed files, whose entries or stats rows
+    would not be bounded by max_range_size.
+    """
+
+    pending = []
+    for args in ranges:
+        name, index, start, end, source = args
+        if pool is None or end is None and (not no_duplicates or incremental):
+            for pending_args, outcome in pending:
+                yield pending_args, outcome.get()
+            pending = []
+            yield args, (iter_byte_range(name, start, end), None)
+            continue
+        pending.append((args, pool.apply_async(parse_byte_range, (args,))))
+        if len(pending) > 2 * jobs:
+            pending_args, outcome = pending.pop(0)
+            yield pending_args, outcome.get()
+    for pending_args, outcome in pending:
+        yield pending_args, outcome.get()
+
+def expand_input(spec):
+    """Return the (file name, source) pairs of one input argument.
+
+    spec is a file name or glob pattern, optionally prefixed with "source="
+    (i.e. the server name), or @manifest, a file with one such input per
+    line. Relative names in a manifest are relative to its directory.
+    """
+
+    if spec[:1] == '@':
         try:
-            from pysqlite2 import dbapi2 as sqlite3
-        except ImportError, e:
-            print >>sys.stderr, "ERROR: Python sqlite3 module not available"
+            f = open(spec[1:], 'r')
+        except IOError, e:
+            print >>sys.stderr, "ERROR: Cannot read manifest %s: %s" % (spec[1:], e.strerror)
             sys.exit()
-    con = sqlite3.connect("mysql_filter_slow_log.sqlite3")
-    cur = con.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS files (file VARCHAR NOT NULL PRIMARY KEY, last_pos INTEGER NOT NULL DEFAULT 0, last_update INTEGER NOT NULL DEFAULT 0)")
-    cur.execute("CREATE TABLE IF NOT EXISTS hosts (host_id INTEGER PRIMARY KEY, host VARCHAR(255) NOT NULL UNIQUE)")
-    cur.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, user VARCHAR(255) NOT NULL UNIQUE)")
-    cur.execute("CREATE TABLE IF NOT EXISTS queries (query_id INTEGER PRIMARY KEY, query TEXT NOT NULL UNIQUE)")
-    cur.execute("CREATE TABLE IF NOT EXISTS stats (host_id INTEGER UNSIGNED NOT NULL, user_id INTEGER UNSIGNED NOT NULL, query_id INTEGER UNSIGNED NOT NULL, unixdate INTEGER UNSIGNED NOT NULL, query_time INTEGER UNSIGNED NOT NULL, lock_time INTEGER UNSIGNED NOT NULL, rows_sent INTEGER UNSIGNED NOT NULL, rows_examined INTEGER UNSIGNED NOT NULL, PRIMARY KEY(host_id, user_id, query_id, unixdate))")
-    # SELECT host,user,query,COUNT(unixdate) AS execution_count, avg(query_time) AS avg_query_time, max(query_time) AS max_query_time, sum(query_time) AS sum_query_time, avg(lock_time) AS avg_lock_time, max(lock_time) AS max_lock_time, sum(lock_time) AS sum_lock_time, avg(rows_examined) AS avg_rows_examined, max(rows_examined) AS max_rows_examined, sum(rows_examined) AS sum_rows_examined, avg(rows_sent) AS avg_rows_sent, max(rows_sent) AS max_rows_sent, sum(rows_sent) AS sum_rows_sent FROM stats LEFT JOIN hosts USING (host_id) LEFT JOIN users ON (users.user_id=stats.user_id) LEFT JOIN queries ON (queries.query_id=stats.query_id) GROUP BY stats.query_id ORDER BY sum_query_time DESC, avg_query_time DESC, max_query_time DESC, sum_lock_time DESC, avg_lock_time DESC, max_lock_time DESC, sum_rows_examined DESC, avg_rows_examined DESC, max_rows_examined DESC, execution_count DESC, sum_rows_sent DESC, avg_rows_sent DESC, max_rows_sent DESC;
+        inputs = []
+        for line in f:
+            line = line.strip()
+            if line and line[0] != '#':
+                source = None
+                if not os.path.isfile(line) and '=' in line:
+                    source, line = line.split('=', 1)
+                    source += '='
+                line = os.path.join(os.path.dirname(spec[1:]), line)
+                inputs.extend(expand_input((source or '') + line))
+        f.close()
+        return inputs
+
+    source = None
+    if not os.path.isfile(spec) and '=' in spec:
+        source, spec = spec.split('=', 1)
+    if os.path.isfile(spec):
+        names = [spec]
+    else:
+        names = [name for name in sorted(glob.glob(spec))
+                 if os.path.isfile(name)]
+    if not names:
+        print >>sys.stderr, "ERROR: No input file found for %s" % spec
+        sys.exit()
+    return [(name, source) for name in names]
 
-    cur.execute("SELECT last_pos FROM files WHERE file=?", (infile.name,))
-    last_pos = cur.fetchone()
-    last_pos = last_pos and last_pos[0] or 0
-    if last_pos: infile.seek(last_pos) # TODO: infile != stdin, last_pos < size
+def tag_entries(entries, k, source):
+    """Yield (t, k, source, entry) of all entries for merge_entries()."""
 
-for line in infile:
-    if not line: continue
-    if line[0] == '#' and line[1] == ' ':
-        if query:
-            if include_queries:
-                in_query = False
-                for iq in include_queries:
-                    if iq in query:
-                        in_query = True
-                        break
-            if in_query:
-                process_query(queries, query, no_duplicates, user, host,
-                              timestamp, query_time, ls)
-            query = ''
-            in_query = False
+    for entry in entries:
+        yield entry[4], k, source, entry
 
-        if line[2] == 'T':  # # Time: 070119 12:29:58
-            timestamp = line[8:-1]
-            t = get_log_timestamp(timestamp)
-            if date_first and t < date_first or date_last and t > date_last:
-                timestamp = False
-        elif line[2] == 'U' and timestamp: # # User@Host: root[root] @ localhost []
-            user, host = line[13:-1].split(' @ ', 2)
-
-            if not include_hosts:
-                in_query = True
-                for eh in exclude_hosts:
-                    if eh in host:
-                        in_query = False
-                        break
-            else:
-                in_query = False
-                for ih in include_hosts:
-                    if ih in host:
-                        in_query = True
-                        break
-
-            if not in_query: continue
-
-            if not include_users:
-                in_query = True
-                for eu in exclude_users:
-                    if eu in user:
-                        in_query = False
-                        break
-            else:
-                in_query = False
-                for iu in include_users:
-                    if iu in user:
-                        in_query = True
-                        break
-        # # Query_time: 0  Lock_time: 0  Rows_sent: 0  Rows_examined: 156
-        elif in_query and line[2] == 'Q':
-            numbers = line[12:-1].split(':')
-            query_time = (int(numbers[1].split()[0]), int(numbers[2].split()[0]),
-                          int(numbers[3].split()[0]), int(numbers[4]))
-            in_query = query_time[0] >= min_query_time or (min_rows_examined
-                       and query_time[3] >= min_rows_examined)
+def merge_entries(inputs):
+    """Yield (source, entry) of all entries of the (source, entries) inputs
+    in the order of their timestamps, like sort -m does for sorted files.
 
-    elif in_query:
-        query += line[:-1]
+    Only the next entry of each input is kept in the heap.
+    """
 
-if query:
-    process_query(queries, query, no_duplicates, user, host, timestamp,
-                  query_time, ls)
+    if len(inputs) == 1:
+        source, entries = inputs[0]
+        for entry in entries:
+            yield source, entry
+        return
+    for t, k, source, entry in heapq.merge(*[tag_entries(entries, k, source)
+                                 for k, (source, entries) in enumerate(inputs)]):
+        yield source, entry
+
+def get_ids(cur, table, column, keys):
+    """Return a dict of the ids of all keys, which are added if necessary."""
+
+    cur.executemany("INSERT OR IGNORE INTO %s (%s) VALUES (?)" % (table, column),
+                    [(key,) for key in keys])
+    ids = {}
+    # Stay below the default SQLITE_MAX_VARIABLE_NUMBER of 999
+    for i in range(0, len(keys), 500):
+        part = keys[i:i+500]
+        cur.execute("SELECT %s, %s_id FROM %s WHERE %s IN (%s)" % (column,
+                    column, table, column, ','.join(['?'] * len(part))), part)
+        ids.update(cur.fetchall())
+    return ids
+
+def write_stats(con, rows, commit=True):
+    """Write and clear one batch of (query, user, host, unixdate, query_time,
+    lock_time, rows_sent, rows_examined) stats rows in a single transaction,
+    or in the one of the caller unless commit is set.
+
+    Only the ids of the queries, users and hosts in the batch are resolved.
+    """
 
-if queries and no_duplicates:
-    if con:
-        db_queries = {}
-        cur.execute("SELECT * FROM queries")
-        for (id, query) in cur: db_queries[query] = id
-        db_query_id = 1
-        if db_queries:
-            db_query_id = max(db_queries.values()) + 1
-
-        db_hosts = {}
-        cur.execute("SELECT * FROM hosts")
-        for (id, host) in cur: db_hosts[host] = id
-        db_host_id = 1
-        if db_hosts:
-            db_host_id = max(db_hosts.values()) + 1
-
-        db_users = {}
-        cur.execute("SELECT * FROM users")
-        for (id, user) in cur: db_users[user] = id
-        db_user_id = 1
-        if db_users:
-            db_userid = max(db_users.values()) + 1
+    cur = con.cursor()
+    if commit:
+        cur.execute("BEGIN")
+    try:
+        query_ids = get_ids(cur, 'queries', 'query',
+                            array_unique([row[0] for row in rows]))
+        user_ids = get_ids(cur, 'users', 'user',
+                           array_unique([row[1] for row in rows]))
+        host_ids = get_ids(cur, 'hosts', 'host',
+                           array_unique([row[2] for row in rows]))
+        resolved = [(host_ids[row[2]], user_ids[row[1]], query_ids[row[0]])
+                    + row[3:] for row in rows]
+        cur.executemany("REPLACE INTO stats VALUES(?,?,?,?,?,?,?,?)", resolved)
+        write_rollups(cur, resolved)
+    except:
+        if commit:
+            cur.execute("ROLLBACK")
+        raise
+    if commit:
+        cur.execute("COMMIT")
+    if run_stats is not None:
+        run_stats.count('database rows written', len(rows))
+    del rows[:]
+
+def merge_rollup(rollup, other):
+    """Merge the rollup values of other into the list rollup."""
+
+    rollup[0] += other[0]
+    sketch_merge(rollup[11], other[11])
+    if other[1] < rollup[1]:
+        rollup[1] = other[1]
+    if other[2] > rollup[2]:
+        rollup[2] = other[2]
+    for i in (3, 5, 7, 9):
+        rollup[i] += other[i]
+        if other[i+1] > rollup[i+1]:
+            rollup[i+1] = other[i+1]
+
+def write_rollups(cur, rows):
+    """Add the resolved stats rows to the hourly and daily rollup tables."""
+
+    hourly = {}
+    for host_id, user_id, query_id, t, query_time, lock_time, rows_sent,\
+        rows_examined in rows:
+        key = (query_id, int(t) - int(t) % 3600)
+        rollup = [1, t, t, query_time, query_time, lock_time, lock_time,
+                  rows_sent, rows_sent, rows_examined, rows_examined, {}]
+        sketch_add(rollup[11], query_time)
+        if key in hourly:
+            merge_rollup(hourly[key], rollup)
+        else:
+            hourly[key] = rollup
+
+    daily = {}
+    for (query_id, hour), rollup in hourly.iteritems():
+        if hour not in day_cache:
+            day_cache[hour] = int(time.mktime(time.localtime(hour)[:3] +
+                                              (0, 0, 0, 0, 0, -1)))
+        key = (query_id, day_cache[hour])
+        if key in daily:
+            merge_rollup(daily[key], rollup)
+        else:
+            daily[key] = rollup[:11] + [dict(rollup[11])]
+
+    for table, rollups in (('stats_hourly', hourly), ('stats_daily', daily)):
+        cur.executemany("INSERT OR IGNORE INTO %s (query_id, unixdate) "
+                        "VALUES (?,?)" % table, rollups.keys())
+        # The sketches are merged here, they are just text to SQLite
+        for key, rollup in rollups.iteritems():
+            cur.execute("SELECT query_time_sketch FROM %s WHERE query_id=? "
+                        "AND unixdate=?" % table, key)
+            sketch_merge(rollup[11], load_sketch(cur.fetchone()[0]))
+            rollup[11] = dump_sketch(rollup[11])
+        cur.executemany("UPDATE %s SET execution_count=execution_count+?, "
+            "min_unixdate=MIN(min_unixdate,?), max_unixdate=MAX(max_unixdate,?), "
+            "sum_query_time=sum_query_time+?, max_query_time=MAX(max_query_time,?), "
+            "sum_lock_time=sum_lock_time+?, max_lock_time=MAX(max_lock_time,?), "
+            "sum_rows_sent=sum_rows_sent+?, max_rows_sent=MAX(max_rows_sent,?), "
+            "sum_rows_examined=sum_rows_examined+?, "
+            "max_rows_examined=MAX(max_rows_examined,?), query_time_sketch=? "
+            "WHERE query_id=? AND unixdate=?" % table,
+            [tuple(rollup) + key for key, rollup in rollups.iteritems()])
+
+def read_rollups(cur):
+    """Return an Aggregator of the --date range from the rollup tables.
+
+    The daily rollups are used if the range starts and ends at midnight.
+    """
 
+    table = 'stats_daily'
+    if bucket_size and bucket_size < 86400:
+        table = 'stats_hourly'
+    where = []
+    params = []
+    for bound, condition in ((date_first, 'unixdate >= ?'),
+                             (date_last, 'unixdate < ?')):
+        if bound:
+            if time.localtime(bound)[3:6] != (0, 0, 0):
+                table = 'stats_hourly'
+            where.append(condition)
+            params.append(bound)
+    cur.execute("SELECT query, SUM(execution_count), MIN(min_unixdate), "
+        "MAX(max_unixdate), SUM(sum_query_time), MAX(max_query_time), "
+        "SUM(sum_lock_time), MAX(max_lock_time), SUM(sum_rows_sent), "
+        "MAX(max_rows_sent), SUM(sum_rows_examined), MAX(max_rows_examined) "
+        "FROM %s JOIN queries USING (query_id) %s GROUP BY query_id" % (table,
+        where and 'WHERE ' + ' AND '.join(where) or ''), params)
+
+    aggregator = Aggregator()
+    queries = aggregator.queries
+    for row in cur:
+        stats = queries[row[0]] = QueryStats()
+        stats.execution_count, stats.min_timestamp, stats.max_timestamp,\
+        stats.sum_query_time, stats.max_query_time, stats.sum_lock_time,\
+        stats.max_lock_time, stats.sum_rows_sent, stats.max_rows_sent,\
+        stats.sum_rows_examined, stats.max_rows_examined = row[1:]
+        stats.min_query_time = 0 # not in the rollups
+    cur.execute("SELECT query, query_time_sketch FROM %s JOIN queries "
+                "USING (query_id) %s" % (table,
+                where and 'WHERE ' + ' AND '.join(where) or ''), params)
+    for query, sketch in cur:
+        sketch_merge(queries[query].query_time_sketch, load_sketch(sketch))
+
+    if bucket_size:
+        cur.execute("SELECT query, unixdate, execution_count, sum_query_time, "
+            "max_query_time FROM %s JOIN queries USING (query_id) %s" % (table,
+            where and 'WHERE ' + ' AND '.join(where) or ''), params)
+        for query, t, execution_count, sum_query_time, max_query_time in cur:
+            stats = queries[query]
+            bucket = get_bucket(t)
+            if stats.buckets is None:
+                stats.buckets = BucketSeries()
+            stats.buckets.add(bucket, execution_count, sum_query_time,
+                              max_query_time)
+    return aggregator
+
+def get_percentiles(stats):
+    """Return the query time percentiles of the QueryStats stats.
+
+    The sketch estimates are rounded to whole seconds like the logged query
+    times and kept between their minimum and maximum, so a query which
+    always took 8 seconds has the percentiles 8, not 7.9.
+    """
+
+    return [min(max(int(round(value)), stats.min_query_time),
+                stats.max_query_time) for value in
+            sketch_quantiles(stats.query_time_sketch,
+                             [p / 100.0 for i, p in percentiles])]
+
+def sort_report(aggregator):
+    """Return the (query, data) report lines of the --top unique queries in
+    --sort order."""
+
+    # The percentiles are only estimated for all queries if sorted by them
+    sort_percentiles = [i for i, p in percentiles if i in new_sorting]
+    queries = aggregator.queries.iteritems()
+    attribute = sort_attributes.get(new_sorting[0])
+    if top and attribute and len(aggregator.queries) > top:
+        # Only the queries of at least the top-th largest first sort value
+        # can be printed, the others are not sorted at all
+        threshold = heapq.nlargest(top, [getattr(stats, attribute) for stats
+                                         in aggregator.queries.itervalues()])[-1]
+        queries = [(key, stats) for key, stats in queries
+                   if getattr(stats, attribute) >= threshold]
     lines = {}
-    for query, users in queries.items():
-        if con:
-            if query in db_queries:
-                query_id = db_queries[query]
-            else:
-                query_id = db_query_id
-                db_queries[query] = query_id
-                cur.execute("INSERT INTO queries VALUES(?,?)", (query_id, query))
-                db_query_id += 1
-
-        execution_count = 0
-        max_timestamp = 0.0
-        min_timestamp = 2147483647.0 # MAX_INT
-        sum_query_time = max_query_time = 0
-        sum_lock_time = max_lock_time = 0
-        sum_rows_examined = max_rows_examined = 0
-        sum_rows_sent = max_rows_sent = 0
-        output = ''
-        for user, timestamps in sorted(users.iteritems(), cmp_users):
-            output += "# User@Host: %s%s" % (user, ls)
-            if con:
-                user, host = user.split(' @ ', 2)
-                if user in db_users:
-                    user_id = db_users[user]
-                else:
-                    user_id = db_user_id
-                    db_users[user] = user_id
-                    cur.execute("INSERT INTO users VALUES(?,?)", (user_id, user))
-                    db_user_id += 1
-                if host in db_hosts:
-                    host_id = db_hosts[host]
-                else:
-                    host_id = db_host_id
-                    db_hosts[host] = host_id
-                    cur.execute("INSERT INTO hosts VALUES(?,?)", (host_id, host))
-                    db_host_id += 1
-
-            query_times = {}
-            for t, query_time in timestamps.iteritems():
-                t = get_log_timestamp(t)
-                if not query_times.has_key(query_time):
-                    query_times[query_time] = "# Query_time: %d  Lock_time: "\
-                        "%d  Rows_sent: %d  Rows_examined: %d%s" % (query_time[0],
-                        query_time[1], query_time[2], query_time[3], ls)
-                    if query_time[0] > max_query_time:
-                        max_query_time = query_time[0]
-                    if query_time[1] > max_lock_time:
-                        max_lock_time = query_time[1]
-                    if query_time[2] > max_rows_sent:
-                        max_rows_sent = query_time[2]
-                    if query_time[3] > max_rows_examined:
-                        max_rows_examined = query_time[3]
-                if t < min_timestamp:
-                    min_timestamp = t
-                elif t > max_timestamp:
-                    max_timestamp = t
-                sum_query_time += query_time[0]
-                sum_lock_time += query_time[1]
-                sum_rows_sent += query_time[2]
-                sum_rows_examined += query_time[3]
-                execution_count += 1
-
-                if con:
-                    cur.execute("REPLACE INTO stats VALUES(?,?,?,?,?,?,?,?)", (
-                        host_id, user_id, query_id, t, query_time[0],
-                        query_time[1], query_time[2], query_time[3]))
+    for key, stats in queries:
+        query = key
+        if fingerprint:
+            query = aggregator.samples[key][1]
+        execution_count = stats.execution_count
+        avg_query_time = round(float(stats.sum_query_time) / float(execution_count), 1)
+        avg_lock_time = round(float(stats.sum_lock_time) / float(execution_count), 1)
+        avg_rows_sent = round(stats.sum_rows_sent / execution_count, 0)
+        avg_rows_examined = round(stats.sum_rows_examined / execution_count, 0)
+        lines[query] = [key, execution_count, avg_query_time,
+                        stats.max_query_time, stats.sum_query_time,
+                        avg_lock_time, stats.max_lock_time,
+                        stats.sum_lock_time, avg_rows_sent,
+                        stats.max_rows_sent, stats.sum_rows_sent,
+                        avg_rows_examined, stats.max_rows_examined,
+                        stats.sum_rows_examined, stats.min_timestamp,
+                        stats.max_timestamp]
+        if sort_percentiles:
+            lines[query].extend(get_percentiles(stats))
+
+    # Only the printed queries are selected and formatted
+    if top:
+        selected = heapq.nsmallest(top, lines.iteritems(), query_sort_key)
+    else:
+        selected = sorted(lines.iteritems(), key=query_sort_key)
+    if not sort_percentiles:
+        for query, data in selected:
+            data.extend(get_percentiles(aggregator.queries[data[0]]))
+    return selected
 
-            if details:
-                for query_time in sorted(query_times.iterkeys(), cmp_query_times):
-                    output += query_times[query_time]
-        output += "%s%s%s" % (ls, query, ls*2)
-        avg_query_time = round(float(sum_query_time) / float(execution_count), 1)
-        avg_lock_time = round(float(sum_lock_time) / float(execution_count), 1)
-        avg_rows_sent = round(sum_rows_sent / execution_count, 0)
-        avg_rows_examined = round(sum_rows_examined / execution_count, 0)
-        lines[query] = [output, execution_count, avg_query_time, max_query_time,
-                        sum_query_time, avg_lock_time, max_lock_time,
-                        sum_lock_time, avg_rows_sent, max_rows_sent,
-                        sum_rows_sent, avg_rows_examined, max_rows_examined,
-                        sum_rows_examined, min_timestamp, max_timestamp]
+def print_report(aggregator):
+    """Print the statistics of the unique queries."""
 
     if no_output:
-        lines.clear() # Do not output if incremental processing
+        return # Do not output if incremental processing
 
-    i = 0
-    for query, data in sorted(lines.iteritems(), cmp_queries):
+    for query, data in sort_report(aggregator):
         # Determine maximum size for each column
         max_length = [3,3,3]
         for k in range(2, 14):
@@ -610,14 +1897,15 @@ if queries and no_duplicates:
             if max_length[0] >= 5:
                 max_length[0] -= 2
 
-        output, execution_count, avg_query_time, max_query_time,\
+        key, execution_count, avg_query_time, max_query_time,\
         sum_query_time, avg_lock_time, max_lock_time, sum_lock_time,\
         avg_rows_sent, max_rows_sent, sum_rows_sent, avg_rows_examined,\
-        max_rows_examined, sum_rows_examined, min_timestamp, max_timestamp = data
+        max_rows_examined, sum_rows_examined, min_timestamp, max_timestamp,\
+        p50_query_time, p95_query_time, p99_query_time = data
 
         execution_count = number_format(data[1])
         print "# Execution count: %s time%s" % (execution_count, data[1] != 1 and 's' or ''),
-        if max_timestamp:
+        if max_timestamp > min_timestamp:
           print "between %s and %s.%s" % (time.strftime(date_format, time.localtime(min_timestamp)), time.strftime(date_format, time.localtime(max_timestamp)), ls),
         else:
           print "on %s.%s" % (time.strftime(date_format, time.localtime(min_timestamp)), ls),
@@ -627,14 +1915,1483 @@ if queries and no_duplicates:
         print "# Lock time    :", avg_lock_time.rjust(max_length[0]), "|", max_lock_time.rjust(max_length[1]), "| %s%s" % (sum_lock_time.rjust(max_length[2]), ls),
         print "# Rows examined:", avg_rows_examined.rjust(max_length[0]), "|", max_rows_examined.rjust(max_length[1]), "| %s%s" % (sum_rows_examined.rjust(max_length[2]), ls),
         print "# Rows sent    :", avg_rows_sent.rjust(max_length[0]), "|", max_rows_sent.rjust(max_length[1]), "| %s%s" % (sum_rows_sent.rjust(max_length[2]), ls),
+        print "# Query time percentiles: 50%%: %s, 95%%: %s, 99%%: %s%s" % (number_format(p50_query_time), number_format(p95_query_time), number_format(p99_query_time), ls),
+        stats = aggregator.queries[key]
+        output = ''
+        if key in aggregator.errors:
+            output += "# Max groups error: the %s may be up to %s higher%s" % (
+                      max_groups_weight.replace('_', ' '),
+                      number_format(aggregator.errors[key]), ls)
+        if stats.sources:
+            output += "# Sources: %s%s" % (', '.join(['%s (%s)' % (source,
+                      number_format(stats.sources[source])) for source in
+                      sorted(stats.sources)]), ls)
+        for user, query_times in sorted(stats.users.iteritems(), cmp_users):
+            output += "# User@Host: %s%s" % (user, ls)
+            if details:
+                for query_time in sorted(query_times, cmp_query_times):
+                    output += "# Query_time: %d  Lock_time: %d  Rows_sent: %d"\
+                              "  Rows_examined: %d%s" % (query_time[0],
+                              query_time[1], query_time[2], query_time[3], ls)
+        if stats.executions is not None:
+            executions = stats.executions
+            output += "# Slowest executions:%s" % ls
+            for worst_key, user in sorted(executions.worst, reverse=True):
+                output += "# Query_time: %d  Lock_time: %d  Rows_sent: %d"\
+                          "  Rows_examined: %d  User@Host: %s%s" % (
+                          worst_key[0], worst_key[1], worst_key[3],
+                          worst_key[2], user, ls)
+            if executions.seen > len(executions.sample):
+                output += "# Random sample of %s of %s executions:%s" % (
+                          number_format(len(executions.sample)),
+                          number_format(executions.seen), ls)
+                sample = sorted(executions.sample, lambda a, b:
+                                cmp_query_times(a[2], b[2]) or cmp(a, b))
+                for item, user, query_time in sample:
+                    output += "# Query_time: %d  Lock_time: %d  Rows_sent: %d"\
+                              "  Rows_examined: %d  User@Host: %s%s" % (
+                              query_time[0], query_time[1], query_time[2],
+                              query_time[3], user, ls)
+        if stats.buckets is not None:
+            rows = [(time.strftime(date_format, time.localtime(get_bucket_start(bucket))),
+                     number_format(count), number_format(sum_query_time),
+                     number_format(max_query_time)) for bucket, count,
+                    sum_query_time, max_query_time in stats.buckets.rows()]
+            max_length = [max([len(row[c]) for row in rows] + [len(title)]) for c, title in
+                          enumerate(['Time bucket', 'count', 'sum query time', 'max'])]
+            output += "# %s : %s | %s | %s%s" % ('Time bucket'.ljust(max_length[0]),
+                      'count'.rjust(max_length[1]), 'sum query time'.rjust(max_length[2]),
+                      'max'.rjust(max_length[3]), ls)
+            for row in rows:
+                output += "# %s : %s | %s | %s%s" % (row[0].ljust(max_length[0]),
+                          row[1].rjust(max_length[1]), row[2].rjust(max_length[2]),
+                          row[3].rjust(max_length[3]), ls)
+        if fingerprint:
+            output += "# Fingerprint: %s%s" % (aggregator.samples[key][0], ls)
+        output += "%s%s%s" % (ls, query, ls*2)
         print output,
 
-        if top:
-            i += 1
-            if i >= top:
+def to_unicode(s):
+    """Return s decoded as UTF-8 or, if it is no valid UTF-8, as Latin-1."""
+
+    if isinstance(s, unicode):
+        return s
+    try:
+        return s.decode('utf-8')
+    except UnicodeDecodeError:
+        return s.decode('latin-1')
+
+class RecordWriter(object):
+    """Buffered writer of --format=ndjson|csv|msgpack records to STDOUT.
+
+    A record is the list of the values of fields. Values are written as they
+    are, without any locale formatting, and ndjson objects and msgpack maps
+    have their keys in the order of fields. The encoded records are
+    collected and written in blocks of about write_buffer_size bytes.
+    """
+
+    def __init__(self, output_format, fields):
+        self.fields = fields
+        self.pieces = []
+        self.size = 0
+        self.encode = None
+        if output_format == 'csv':
+            import csv
+            self.csv = csv.writer(self, lineterminator=ls)
+            self.csv.writerow(fields)
+        elif output_format == 'ndjson':
+            import json
+            encode = json.JSONEncoder(separators=(',', ':')).encode
+            self.encode = lambda pairs: '{%s}\n' % ','.join(
+                [encode(field) + ':' + encode(value) for field, value in pairs])
+        else:
+            try:
+                import msgpack
+            except ImportError, e:
+                print >>sys.stderr, "ERROR: Python msgpack module not available"
+                sys.exit()
+            packer = msgpack.Packer(use_bin_type=True)
+            self.encode = lambda pairs: packer.pack_map_header(len(pairs)) +\
+                ''.join([packer.pack(field) + packer.pack(value)
+                         for field, value in pairs])
+
+    def write(self, data):
+        """Buffer encoded data, also called by the csv writer."""
+
+        self.pieces.append(data)
+        self.size += len(data)
+        if self.size >= write_buffer_size:
+            self.flush()
+
+    def add(self, values):
+        """Write one record. Only the values of fields are written as CSV."""
+
+        if self.encode is None:
+            self.csv.writerow([isinstance(value, unicode) and
+                               value.encode('utf-8') or value
+                               for value in values[:len(self.fields)]])
+            return
+        pairs = zip(self.fields, values)
+        try:
+            self.write(self.encode(pairs))
+        except UnicodeDecodeError:
+            # Strings are encoded as UTF-8 unless they are no valid UTF-8
+            pairs = [(field, isinstance(value, str) and to_unicode(value) or
+                      value) for field, value in pairs]
+            self.write(self.encode(pairs))
+
+    def flush(self):
+        """Write all buffered records."""
+
+        sys.stdout.write(''.join(self.pieces))
+        sys.stdout.flush()
+        del self.pieces[:]
+        self.size = 0
+
+def write_bucket_rows(aggregator):
+    """Write one --format record per --bucket time bucket of the unique
+    queries."""
+
+    if no_output:
+        return
+
+    for query, data in sort_report(aggregator):
+        key = data[0]
+        if fingerprint:
+            query = aggregator.samples[key][0]
+        for bucket, count, sum_query_time, max_query_time in\
+            aggregator.queries[key].buckets.rows():
+            record_writer.add([time.strftime('%Y-%m-%d %H:%M:%S',
+                               time.localtime(get_bucket_start(bucket))),
+                               query, count, sum_query_time, max_query_time])
+
+def write_report_records(aggregator):
+    """Write one --format record per unique query in report order."""
+
+    if no_output:
+        return
+
+    for query, data in sort_report(aggregator):
+        key = data[0]
+        stats = aggregator.queries[key]
+        query_fingerprint = None
+        if fingerprint:
+            query_fingerprint = aggregator.samples[key][0]
+        buckets = None
+        if stats.buckets is not None:
+            buckets = [[get_bucket_start(bucket), count, sum_query_time,
+                        max_query_time] for bucket, count, sum_query_time,
+                       max_query_time in stats.buckets.rows()]
+        values = [query, query_fingerprint] + data[1:14] + data[16:19] +\
+                 [data[14], data[15]]
+        if max_groups:
+            values.append(aggregator.errors.get(key, 0))
+        record_writer.add(values + [[to_unicode(user) for user in
+                          sorted(stats.users)], stats.sources, buckets])
+
+def output_report(aggregator):
+    """Print or write the statistics of the unique queries in --format."""
+
+    if output_format == 'text':
+        print_report(aggregator)
+    elif bucket_size and output_format == 'csv':
+        write_bucket_rows(aggregator)
+    else:
+        write_report_records(aggregator)
+
+def follow_lines(f, tick, interval=None):
+    """Yield the lines of the growing file f like tail -f does.
+
+    If the file was rotated (new inode), truncated or rewritten (its first
+    bytes changed), follow_reset is yielded, so that no entry spans both
+    files, and reading continues at the beginning of the new file. Before
+    tick(f, offset) is called every interval (default: flush_interval)
+    seconds, "# " is yielded, so that the last entry is completed.
+    """
+
+    name = f.name
+    interval = interval or flush_interval
+    head = read_head(f)
+    partial = ''
+    pending = False # lines were yielded since the last "# "
+    next_tick = time.time() + interval
+    while True:
+        line = f.readline()
+        if line:
+            if line[-1] != '\n':
+                partial += line # incomplete line, wait for the rest
+                continue
+            if partial:
+                line = partial + line
+                partial = ''
+            if pending and line[:3] in ('# T', '# U') and\
+               time.time() >= next_tick:
+                yield '# \n'
+                pending = False
+                tick(f, f.tell() - len(line))
+                next_tick = time.time() + interval
+            pending = True
+            yield line
+            continue
+
+        if pending:
+            yield '# \n'
+            pending = False
+        if time.time() >= next_tick:
+            tick(f, f.tell() - len(partial))
+            next_tick = time.time() + interval
+        try:
+            st = os.stat(name)
+        except OSError, e:
+            st = None # rotation in progress
+        if st and st.st_ino != os.fstat(f.fileno()).st_ino:
+            f.close()
+            f = open(name, 'r')
+        elif st and (st.st_size < f.tell() or
+                     read_head(f)[:len(head)] != head):
+            f.seek(0) # truncated or rewritten
+        else:
+            if len(head) < head_size:
+                head = read_head(f)
+            time.sleep(poll_interval)
+            f.seek(0, 1) # reset EOF
+            continue
+        head = read_head(f)
+        partial = ''
+        yield follow_reset
+
+def read_head(f):
+    """Return the first head_size bytes of f, its position is kept."""
+
+    offset = f.tell()
+    f.seek(0)
+    head = f.read(head_size)
+    f.seek(offset)
+    return head
+
+def flush_follow(f, offset):
+    """Write, checkpoint and print everything collected since the last call.
+
+    The stats rows and the file offset after them are saved in one
+    transaction, so that no entry is added to the rollups twice.
+    """
+
+    if incremental:
+        cur.execute("BEGIN")
+        try:
+            if aggregator.db_rows:
+                write_stats(con, aggregator.db_rows, False)
+            cur.execute("REPLACE INTO files VALUES (?,?,strftime('%s','now'))",
+                        (f.name, offset))
+        except:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
+    if no_duplicates:
+        aggregator.report()
+        aggregator.clear()
+    if record_writer is not None:
+        record_writer.flush()
+    sys.stdout.flush()
+
+def follow_daemon_file(infile, source, lock, positions, failures):
+    """Add the new entries of infile to the aggregator every poll_interval
+    seconds and keep its position in positions (--daemon thread).
+
+    If following fails, the error is printed and kept in failures until
+    the file was reopened at its last position and followed again.
+    """
+
+    import traceback
+
+    collected = Aggregator()
+
+    def tick(f, offset):
+        lock.acquire()
+        try:
+            aggregator.merge(collected)
+            positions[infile.name] = offset
+            failures.pop(infile.name, None)
+        finally:
+            lock.release()
+        collected.clear()
+        del collected.db_rows[:]
+
+    f = infile
+    while True:
+        try:
+            for entry in parse_entries(follow_lines(f, tick, poll_interval)):
+                collected.add(entry, source)
+        except Exception, e:
+            message = "Following %s failed: %s" % (infile.name, e)
+            lock.acquire()
+            try:
+                repeated = failures.get(infile.name) == message
+                failures[infile.name] = message
+                offset = positions[infile.name]
+            finally:
+                lock.release()
+            if not repeated:
+                print >>sys.stderr, "ERROR: %s" % message
+                traceback.print_exc()
+            # The entries since the last tick are read again
+            collected.clear()
+            del collected.db_rows[:]
+            time.sleep(poll_interval)
+            try:
+                f = open(infile.name, 'r')
+                f.seek(offset)
+            except IOError, e:
+                pass # Retried after the next failure of the closed file
+
+def flush_daemon(con, lock, positions):
+    """Save the stats rows and input file positions of all entries added by
+    the --daemon threads so far in one transaction."""
+
+    lock.acquire()
+    try:
+        rows = aggregator.db_rows
+        aggregator.db_rows = []
+        files = positions.items()
+    finally:
+        lock.release()
+    cur = con.cursor()
+    cur.execute("BEGIN")
+    try:
+        if rows:
+            write_stats(con, rows, False)
+        cur.executemany("REPLACE INTO files VALUES (?,?,strftime('%s','now'))",
+                        files)
+    except:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute("COMMIT")
+
+def save_daemon_stats(lock, positions, stopped):
+    """Call flush_daemon() every flush_interval seconds and once more after
+    the event stopped is set (--daemon thread with its own connection, so
+    that requests are answered while the statistics are saved)."""
+
+    con = open_database()
+    while not stopped.wait(flush_interval):
+        flush_daemon(con, lock, positions)
+    flush_daemon(con, lock, positions)
+    con.close()
+
+def parse_request(argv):
+    """Return the (sorting, top, output format, include query search, exclude
+    query search) of the --daemon request arguments argv.
+
+    Options which are not passed keep the values of the daemon. ValueError
+    is raised with the message of an invalid option.
+    """
+
+    sorting = []
+    request_top = top
+    request_format = output_format
+    request_includes = []
+    request_regexes = []
+    request_excludes = []
+    for arg in argv:
+        if '--sort' == arg[:6] and len(arg) > 7 and arg[6] in '=-':
+            parse_sorting(arg[7:], sorting)
+        elif '--top=' == arg[:6]:
+            if not arg[6:].isdigit():
+                raise ValueError("Invalid option %s" % arg)
+            request_top = int(arg[6:]) or request_top
+        elif '--format=' == arg[:9]:
+            request_format = arg[9:]
+            if request_format not in ('text', 'ndjson', 'csv', 'msgpack'):
+                raise ValueError("Unknown output format %s" % request_format)
+            if request_format == 'msgpack':
+                try:
+                    import msgpack
+                except ImportError, e:
+                    raise ValueError("Python msgpack module not available")
+        elif '-iq' == arg[:3]: request_includes.append(arg[4:])
+        elif '-eq' == arg[:3]: request_excludes.append(arg[4:])
+        elif '--include-query=' == arg[:16]: request_includes.append(arg[16:])
+        elif '--exclude-query=' == arg[:16]: request_excludes.append(arg[16:])
+        elif '--include-query-regex=' == arg[:22]:
+            try:
+                re.compile(arg[22:])
+            except re.error, e:
+                raise ValueError("Invalid regular expression %s: %s" % (arg[22:], e))
+            request_regexes.append(arg[22:])
+        else:
+            raise ValueError("--daemon requests only support --sort, --top, --format and the query filters, not %s" % arg)
+    if sorting:
+        complete_sorting(sorting)
+    else:
+        sorting = new_sorting
+    return sorting, request_top, request_format,\
+           compile_filter(request_includes, request_regexes),\
+           compile_filter(request_excludes)
+
+def answer_request(conn, lock, failures):
+    """Send the report of the request line read from the --daemon socket
+    connection conn, or the error of its options. The failures of the
+    followed files are sent as WARNING lines before the report. Socket
+    errors are raised."""
+
+    global new_sorting, top, output_format, record_writer, no_output
+    import cStringIO
+    import shlex
+
+    conn.settimeout(daemon_request_timeout)
+    line = conn.makefile('rb').readline(daemon_request_bytes)
+    if not line:
+        return # i.e. the probe of serve_daemon()
+    try:
+        argv = [arg.decode('utf-8') for arg in shlex.split(line)]
+        sorting, request_top, request_format, include_search, exclude_search =\
+            parse_request(argv)
+    except ValueError, e:
+        conn.sendall("ERROR: %s\n" % e)
+        return
+
+    out = cStringIO.StringIO()
+    saved = (new_sorting, top, output_format, record_writer, no_output,
+             sys.stdout)
+    lock.acquire()
+    try:
+        for name in sorted(failures):
+            out.write("WARNING: %s, the statistics are not up to date\n"
+                      % failures[name])
+        view = Aggregator()
+        view.samples = aggregator.samples
+        view.errors = aggregator.errors
+        for key, stats in aggregator.queries.iteritems():
+            query = fingerprint and aggregator.samples[key][1] or key
+            if exclude_search and exclude_search(query) or\
+               include_search and not include_search(query):
+                continue
+            view.queries[key] = stats
+        new_sorting, top, output_format = sorting, request_top, request_format
+        no_output = False
+        sys.stdout = out
+        record_writer = new_record_writer()
+        if view.queries:
+            output_report(view)
+        if record_writer is not None:
+            record_writer.flush()
+    finally:
+        new_sorting, top, output_format, record_writer, no_output,\
+        sys.stdout = saved
+        lock.release()
+    conn.sendall(out.getvalue())
+
+def serve_daemon(infiles, input_sources):
+    """Follow all infiles in their own threads and answer the report
+    requests on the --daemon socket until Ctrl+C."""
+
+    global aggregator, incremental
+    import errno
+    import select
+    import socket
+    import threading
+
+    if os.path.exists(daemon_socket):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(daemon_socket)
+        except socket.error, e:
+            os.unlink(daemon_socket) # Left by a daemon which was killed
+        else:
+            print >>sys.stderr, "ERROR: A daemon is already listening on %s" % daemon_socket
+            sys.exit()
+        probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0077) # Only the owner may read the queries
+    try:
+        server.bind(daemon_socket)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+
+    aggregator = Aggregator()
+    lock = threading.Lock()
+    positions = dict([(infile.name, infile.tell()) for infile in infiles])
+    failures = {} # file name: error of its follower thread
+    for infile in infiles:
+        thread = threading.Thread(target=follow_daemon_file,
+                                  args=(infile, input_sources.get(infile.name),
+                                        lock, positions, failures))
+        thread.daemon = True # Stops with the main thread
+        thread.start()
+    stopped = threading.Event()
+    saver = threading.Thread(target=save_daemon_stats,
+                             args=(lock, positions, stopped))
+    saver.daemon = True
+    saver.start()
+    try:
+        while True:
+            try:
+                # Ctrl+C is only handled when the main thread runs
+                readable = select.select([server], [], [], poll_interval)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            if readable:
+                conn = server.accept()[0]
+                try:
+                    answer_request(conn, lock, failures)
+                except socket.error, e:
+                    pass # The client went away or did not send its request
+                finally:
+                    conn.close()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    os.unlink(daemon_socket)
+    stopped.set()
+    saver.join()
+    # The other threads stop at their next tick, everything after the last
+    # flush is read again
+    lock.acquire()
+    incremental = False
+    del aggregator.db_rows[:]
+
+def query_daemon(argv):
+    """Send the arguments argv as report request to the --daemon socket
+    query_socket and print its answer, its ERROR and WARNING lines to
+    STDERR."""
+
+    import pipes
+    import socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(query_socket)
+    except socket.error, e:
+        print >>sys.stderr, "ERROR: No daemon is listening on %s: %s" % (query_socket, e)
+        sys.exit()
+    client.sendall(' '.join([pipes.quote(arg.encode('utf-8')) for arg in argv]) + '\n')
+    answer = client.makefile('rb')
+    data = answer.readline()
+    while data[:9] == 'WARNING: ':
+        sys.stderr.write(data)
+        data = answer.readline()
+    if data[:7] == 'ERROR: ':
+        sys.stderr.write(data)
+        sys.exit()
+    while data:
+        sys.stdout.write(data)
+        data = answer.read(write_buffer_size)
+    answer.close()
+    client.close()
+
+
+class RunStats(object):
+    """Wall and CPU seconds of each phase and counters of one run (--stats).
+
+    The phases are timed by instrument()ed functions. Reading and parsing
+    is the time between start_reading() and stop_reading() without the
+    phases called in between.
+    """
+
+    def __init__(self):
+        self.wall = dict.fromkeys(stats_phases, 0.0)
+        self.cpu = dict.fromkeys(stats_phases, 0.0)
+        self.counters = dict.fromkeys(stats_counters, 0)
+        self.reading = None
+
+    def clear(self):
+        """Reset all times and counters (the instrumented functions keep
+        their references to the dictionaries)."""
+
+        for values in (self.wall, self.cpu, self.counters):
+            for key in values:
+                values[key] = 0
+
+    def count(self, counter, n=1):
+        """Add n to counter."""
+
+        self.counters[counter] += n
+
+    def count_lines(self, lines):
+        """Yield lines, counting them and their entries."""
+
+        count = entries = 0
+        try:
+            for line in lines:
+                count += 1
+                if line[:3] == '# U':
+                    entries += 1
+                yield line
+        finally:
+            self.counters['lines read'] += count
+            self.counters['entries seen'] += entries
+
+    def count_buffer(self, buf, start, end):
+        """Count the lines and entries of buf between start and end."""
+
+        lines = entries = 0
+        if not start and buf[:3] == '# U':
+            entries += 1
+        # mmap has no count(), it is counted in slices
+        for pos in xrange(start, end, read_size):
+            lines += buf[pos:min(pos + read_size, end)].count('\n')
+            # Each "\n# U" is counted in the slice it ends in
+            entries += buf[max(pos - 3, start - 1, 0):
+                           min(pos + read_size, end)].count('\n# U')
+        self.counters['lines read'] += lines
+        self.counters['entries seen'] += entries
+
+    def instrument(self, phase, function, rejected=None, passed=None,
+                   reject=False):
+        """Return function wrapped to add its run time to phase.
+
+        The results equal to reject are counted as rejected, the other ones
+        as passed.
+        """
+
+        wall, cpu, counters = self.wall, self.cpu, self.counters
+        def instrumented(*args):
+            start, cpu_start = time.time(), time.clock()
+            try:
+                result = function(*args)
+            finally:
+                wall[phase] += time.time() - start
+                cpu[phase] += time.clock() - cpu_start
+            if not result == reject:
+                if passed: counters[passed] += 1
+            elif rejected:
+                counters[rejected] += 1
+            return result
+        return instrumented
+
+    def start_reading(self):
+        """Start timing the reading and parsing of entries."""
+
+        self.reading = (time.time(), time.clock(), sum(self.wall.values()),
+                        sum(self.cpu.values()))
+
+    def stop_reading(self):
+        """Add the time since start_reading() without the phases called in
+        between to reading and parsing."""
+
+        wall, cpu, phases_wall, phases_cpu = self.reading
+        self.wall['reading and parsing'] += time.time() - wall -\
+            (sum(self.wall.values()) - phases_wall)
+        self.cpu['reading and parsing'] += time.clock() - cpu -\
+            (sum(self.cpu.values()) - phases_cpu)
+
+    def merge(self, other):
+        """Add the times and counters of other, i.e. of a worker process."""
+
+        for values, other_values in ((self.wall, other.wall),
+                                     (self.cpu, other.cpu),
+                                     (self.counters, other.counters)):
+            for key, value in other_values.iteritems():
+                values[key] += value
+
+def instrument_phases(stats):
+    """Replace the functions of each phase by instrument()ed ones and return
+    the original functions."""
+
+    originals = {}
+    for phase, names in (('timestamps', ['get_log_timestamp']),
+                         ('filters', ['is_excluded_time', 'is_included_user',
+                                      'is_slow_query', 'is_included_query']),
+                         ('database', ['open_database', 'write_stats',
+                                       'read_rollups']),
+                         ('output', ['output_entry', 'output_report'])):
+        for name in names:
+            originals[name] = globals()[name]
+    module = globals()
+    module['get_log_timestamp'] = stats.instrument('timestamps', get_log_timestamp)
+    module['is_excluded_time'] = stats.instrument('filters', is_excluded_time)
+    module['is_included_user'] = stats.instrument('filters', is_included_user,
+        'rejected by user/host filters', 'passed user/host filters')
+    module['is_slow_query'] = stats.instrument('filters', is_slow_query,
+                                               'rejected by -T/-R')
+    module['is_included_query'] = stats.instrument('filters', is_included_query,
+        'rejected by query filters', 'entries passed')
+    for name in ('open_database', 'write_stats', 'read_rollups'):
+        module[name] = stats.instrument('database', module[name])
+    for name in ('output_entry', 'output_report'):
+        module[name] = stats.instrument('output', module[name])
+    for name in ('add', 'merge'):
+        originals['Aggregator.' + name] = vars(Aggregator)[name]
+        setattr(Aggregator, name, stats.instrument('aggregation',
+                                                   vars(Aggregator)[name]))
+    return originals
+
+def restore_phases(originals):
+    """Undo instrument_phases()."""
+
+    for name, function in originals.iteritems():
+        if name[:11] == 'Aggregator.':
+            setattr(Aggregator, name[11:], function)
+        else:
+            globals()[name] = function
+
+def print_run_stats(stats, wall, times):
+    """Print the --stats of the run which took wall seconds since os.times()
+    returned times to STDERR."""
+
+    end = os.times()
+    cpu = sum(end[:4]) - sum(times[:4]) # with the workers
+    output = "# Statistics (--stats)%s" % ls
+    output += "# %-31s %10s %10s%s" % ('Phase', 'wall s', 'CPU s', ls)
+    for phase in stats_phases:
+        output += "# %-31s %10.3f %10.3f%s" % (phase, stats.wall[phase],
+                                               stats.cpu[phase], ls)
+    output += "# %-31s %10.3f %10.3f%s" % ('total', wall, cpu, ls)
+    counters = dict(stats.counters)
+    hidden = ['passed user/host filters']
+    if date_first or date_last:
+        counters['rejected by --date'] = counters['entries seen'] -\
+            counters['rejected by user/host filters'] -\
+            counters['passed user/host filters']
+    else:
+        hidden.extend(['bytes skipped by --date', 'rejected by --date'])
+    for counter in stats_counters:
+        if counter not in hidden:
+            output += "# %-31s %10s%s" % (counter + ':',
+                                          number_format(counters[counter]), ls)
+    try:
+        import resource
+        output += "# %-31s %10s KB" % ('peak memory:', number_format(
+                  resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        if jobs > 1:
+            output += " (workers: %s KB)" % number_format(
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        output += ls
+    except ImportError, e:
+        pass # Not available on Windows
+    sys.stderr.write(output)
+
+def parse_sorting(value, sorting):
+    """Append the default_sorting indexes of the comma separated --sort
+    value to sorting, if they are not in it yet."""
+
+    for name in value.split(','):
+        if not name.isdigit() and name in default_sorting:
+            i = default_sorting.index(name)-1
+            if default_sorting[i] not in sorting:
+                sorting.append(default_sorting[i])
+
+def complete_sorting(sorting):
+    """Append all default sorting indexes but the percentiles, which are not
+    in sorting yet, in their default order."""
+
+    for i in range(0, len(default_sorting)-1, 2):
+        if default_sorting[i] not in sorting and\
+           default_sorting[i] not in dict(percentiles):
+            sorting.append(default_sorting[i])
+
+def new_record_writer():
+    """Return the RecordWriter of the current --format, or None for text."""
+
+    fields = report_fields
+    if max_groups:
+        fields = report_fields[:-3] + ['max_groups_error'] + report_fields[-3:]
+    if output_format == 'text':
+        return None
+    elif not no_duplicates:
+        return RecordWriter(output_format, entry_fields)
+    elif bucket_size and output_format == 'csv':
+        return RecordWriter(output_format, bucket_fields)
+    elif output_format == 'csv':
+        return RecordWriter(output_format, fields[:-3])
+    return RecordWriter(output_format, fields)
+
+def parse_args(argv):
+    """Set all options from the command line arguments argv and return the
+    (file name, source) pairs of the input files.
+
+    Options which are not passed get their defaults, so parse_args([])
+    resets them.
+    """
+
+    global min_query_time, min_rows_examined, include_hosts, exclude_hosts
+    global include_users, exclude_users, include_queries, exclude_queries
+    global include_query_regexes, no_duplicates, no_output, details
+    global date_first, date_last, new_sorting, top, incremental, jobs
+    global fingerprint, max_query_bytes, report_from_db, follow
+    global flush_interval, bucket_size, output_format, record_writer
+    global include_host_search, exclude_host_search, include_user_search
+    global exclude_user_search, include_query_search, exclude_query_search
+    global parse_timestamps, collect_stats, profile_file, checkpoint_interval
+    global time_index, max_groups, max_groups_weight, detail_count
+    global daemon_socket, query_socket
+
+    inputs = []
+    names = {}
+    min_query_time = 1
+    min_rows_examined = 0
+    include_hosts = []
+    exclude_hosts = []
+    include_users = []
+    exclude_users = []
+    include_queries = []
+    include_query_regexes = []
+    exclude_queries = []
+    no_duplicates = False
+    no_output = False
+    details = False
+    detail_count = 0
+    date_first = False
+    date_last = False
+    new_sorting = []
+    top = 0
+    incremental = False
+    jobs = 1
+    fingerprint = False
+    max_query_bytes = 0
+    report_from_db = False
+    follow = False
+    flush_interval = 60
+    bucket_size = 0
+    output_format = 'text'
+    collect_stats = False
+    profile_file = None
+    checkpoint_interval = 60
+    time_index = False
+    max_groups = 0
+    daemon_socket = None
+    query_socket = None
+
+    # TODO: use optparse
+    for arg in argv:
+        _arg = arg[:3]
+        try:
+            if '-T=' == _arg: min_query_time = abs(int(arg[3:]))
+            elif '-R=' == _arg: min_rows_examined = abs(int(arg[3:]))
+            elif '-ih' == _arg: include_hosts.append(arg[4:])
+            elif '-eh' == _arg: exclude_hosts.append(arg[4:])
+            elif '-iu' == _arg: include_users.append(arg[4:])
+            elif '-eu' == _arg: exclude_users.append(arg[4:])
+            elif '-iq' == _arg: include_queries.append(arg[4:])
+            elif '-eq' == _arg: exclude_queries.append(arg[4:])
+            elif '--incremental' == arg: incremental = True
+            elif '--no-duplicates' == arg: no_duplicates = True
+            elif '--no-output' == arg: no_output = True
+            elif '--report-from-db' == arg: report_from_db = True
+            elif '--follow' == arg: follow = True
+            elif '--daemon=' == arg[:9] and len(arg) > 9:
+                daemon_socket = arg[9:]
+            elif '--query-daemon=' == arg[:15] and len(arg) > 15:
+                query_socket = arg[15:]
+            elif '--flush-interval=' == arg[:17]:
+                _flush_interval = abs(int(arg[17:]))
+                if _flush_interval:
+                    flush_interval = _flush_interval
+            elif '--checkpoint-interval=' == arg[:22]:
+                checkpoint_interval = abs(int(arg[22:]))
+            elif '--time-index' == arg: time_index = True
+            elif '--details' == arg: details = True
+            elif '--details=' == arg[:10]: detail_count = abs(int(arg[10:]))
+            elif '--bucket=' == arg[:9]:
+                bucket_size = parse_bucket_size(arg[9:])
+                if not bucket_size:
+                    print >>sys.stderr, "ERROR: Invalid bucket size %s, use i.e. 1m, 15m, 1h or 1d" % arg[9:]
+                    sys.exit()
+            elif '--format=' == arg[:9]:
+                output_format = arg[9:]
+                if output_format not in ('text', 'ndjson', 'csv', 'msgpack'):
+                    print >>sys.stderr, "ERROR: Unknown output format %s" % output_format
+                    sys.exit()
+            elif '--fingerprint' == arg: fingerprint = True
+            elif '--max-groups=' == arg[:13]: max_groups = abs(int(arg[13:]))
+            elif '--stats' == arg: collect_stats = True
+            elif '--profile=' == arg[:10] and len(arg) > 10:
+                profile_file = arg[10:]
+            elif '--sort' == arg[:6] and len(arg) > 9 and arg[6] in '=-':
+                parse_sorting(arg[7:], new_sorting)
+            elif '--include-user=' == arg[:15]: include_users.append(arg[15:])
+            elif '--exclude-user=' == arg[:15]: exclude_users.append(arg[15:])
+            elif '--include-host=' == arg[:15]: include_hosts.append(arg[15:])
+            elif '--exclude-host=' == arg[:15]: exclude_hosts.append(arg[15:])
+            elif '--include-query=' == arg[:16]: include_queries.append(arg[16:])
+            elif '--exclude-query=' == arg[:16]: exclude_queries.append(arg[16:])
+            elif '--include-query-regex=' == arg[:22]:
+                try:
+                    re.compile(arg[22:])
+                except re.error, e:
+                    print >>sys.stderr, "ERROR: Invalid regular expression %s: %s" % (arg[22:], e)
+                    sys.exit()
+                include_query_regexes.append(arg[22:])
+            elif '--jobs=' == arg[:7]:
+                _jobs = abs(int(arg[7:]))
+                if _jobs:
+                    jobs = _jobs
+            elif '--max-query-bytes=' == arg[:18]:
+                max_query_bytes = abs(int(arg[18:]))
+            elif '--top=' == arg[:6]:
+                _top = abs(int(arg[6:]))
+                if _top:
+                    top = _top
+            elif '--date=' == arg[:7] and len(arg) > 10:
+                # Do not overwrite already parsed date values
+                if date_first or date_last:
+                    continue
+                date_first, date_last = parse_date_range(arg[7:])
+            elif '--help' == arg:
+                print >>sys.stderr, usage
+                sys.exit()
+            elif arg[:1] != '-':
+                for name, source in expand_input(arg):
+                    if name not in names:
+                        inputs.append((name, source))
+                        names[name] = True
+        except ValueError, e:
+            pass
+
+    if bucket_size:
+        no_duplicates = True
+    if daemon_socket:
+        no_duplicates = True
+        incremental = True
+        follow = False # The daemon follows all input files
+    if report_from_db:
+        no_duplicates = True
+        fingerprint = False # The database only knows the fingerprints
+        details = False
+        detail_count = 0
+        if bucket_size % 3600:
+            print >>sys.stderr, "ERROR: --report-from-db only knows hourly and daily buckets"
+            sys.exit()
+
+    include_hosts = array_unique(include_hosts)
+    exclude_hosts = array_unique(exclude_hosts)
+    include_users = array_unique(include_users)
+    exclude_users = array_unique(exclude_users)
+    # All filters of one kind are matched by one regular expression
+    include_host_search = compile_filter(include_hosts)
+    exclude_host_search = compile_filter(exclude_hosts)
+    include_user_search = compile_filter(include_users)
+    exclude_user_search = compile_filter(exclude_users)
+    include_query_search = compile_filter(include_queries, include_query_regexes)
+    exclude_query_search = compile_filter(exclude_queries)
+    # Queries are tagged with their source if there is more than one
+    if len(inputs) > 1 or [source for name, source in inputs if source]:
+        inputs = [(name, source is None and name or source)
+                  for name, source in inputs]
+    # Log timestamps are only converted if they are needed at all
+    parse_timestamps = bool(no_duplicates or date_first or date_last or
+                            len(inputs) > 1 or output_format != 'text')
+    record_writer = new_record_writer()
+    complete_sorting(new_sorting)
+    # Space-Saving needs a weight which only grows with each execution
+    max_groups_weight = 'sum_query_time'
+    if new_sorting[0] == 1:
+        max_groups_weight = 'execution_count'
+    return inputs
+
+def open_database():
+    """Return a connection to mysql_filter_slow_log.sqlite3 with all tables
+    created or upgraded from earlier versions."""
+
+    try:
+        import sqlite3
+    except ImportError, e:
+        try:
+            from pysqlite2 import dbapi2 as sqlite3
+        except ImportError, e:
+            print >>sys.stderr, "ERROR: Python sqlite3 module not available"
+            sys.exit()
+    con = sqlite3.connect("mysql_filter_slow_log.sqlite3")
+    # Transactions are started explicitly for each batch of stats rows
+    con.isolation_level = None
+    con.text_factory = str
+    cur = con.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA cache_size=-65536") # 64 MB
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("CREATE TABLE IF NOT EXISTS files (file VARCHAR NOT NULL PRIMARY KEY, last_pos INTEGER NOT NULL DEFAULT 0, last_update INTEGER NOT NULL DEFAULT 0)")
+    cur.execute("CREATE TABLE IF NOT EXISTS time_index (file VARCHAR NOT NULL, pos INTEGER NOT NULL, unixdate REAL NOT NULL, PRIMARY KEY(file, pos))")
+    cur.execute("CREATE TABLE IF NOT EXISTS checkpoints (run VARCHAR NOT NULL PRIMARY KEY, options TEXT NOT NULL, state BLOB NOT NULL, last_update INTEGER NOT NULL DEFAULT 0)")
+    cur.execute("CREATE TABLE IF NOT EXISTS hosts (host_id INTEGER PRIMARY KEY, host VARCHAR(255) NOT NULL UNIQUE)")
+    cur.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, user VARCHAR(255) NOT NULL UNIQUE)")
+    cur.execute("CREATE TABLE IF NOT EXISTS queries (query_id INTEGER PRIMARY KEY, query TEXT NOT NULL UNIQUE)")
+    cur.execute("CREATE TABLE IF NOT EXISTS stats (host_id INTEGER UNSIGNED NOT NULL, user_id INTEGER UNSIGNED NOT NULL, query_id INTEGER UNSIGNED NOT NULL, unixdate INTEGER UNSIGNED NOT NULL, query_time INTEGER UNSIGNED NOT NULL, lock_time INTEGER UNSIGNED NOT NULL, rows_sent INTEGER UNSIGNED NOT NULL, rows_examined INTEGER UNSIGNED NOT NULL, PRIMARY KEY(host_id, user_id, query_id, unixdate))")
+    cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='stats_hourly'")
+    rollups = cur.fetchone()[0]
+    for table in ('stats_hourly', 'stats_daily'):
+        cur.execute("CREATE TABLE IF NOT EXISTS %s (query_id INTEGER UNSIGNED NOT NULL, unixdate INTEGER UNSIGNED NOT NULL, execution_count INTEGER UNSIGNED NOT NULL DEFAULT 0, min_unixdate INTEGER UNSIGNED NOT NULL DEFAULT 2147483647, max_unixdate INTEGER UNSIGNED NOT NULL DEFAULT 0, sum_query_time INTEGER UNSIGNED NOT NULL DEFAULT 0, max_query_time INTEGER UNSIGNED NOT NULL DEFAULT 0, sum_lock_time INTEGER UNSIGNED NOT NULL DEFAULT 0, max_lock_time INTEGER UNSIGNED NOT NULL DEFAULT 0, sum_rows_sent INTEGER UNSIGNED NOT NULL DEFAULT 0, max_rows_sent INTEGER UNSIGNED NOT NULL DEFAULT 0, sum_rows_examined INTEGER UNSIGNED NOT NULL DEFAULT 0, max_rows_examined INTEGER UNSIGNED NOT NULL DEFAULT 0, query_time_sketch TEXT NOT NULL DEFAULT '', PRIMARY KEY(query_id, unixdate))" % table)
+        cur.execute("CREATE INDEX IF NOT EXISTS %s_unixdate ON %s (unixdate, query_id)" % (table, table))
+    cur.execute("PRAGMA table_info(stats_hourly)")
+    sketches = 'query_time_sketch' in [row[1] for row in cur.fetchall()]
+    rollup_buckets = (('stats_hourly', "unixdate - unixdate % 3600"),
+                      ('stats_daily', "strftime('%s', unixdate, 'unixepoch', 'localtime', 'start of day', 'utc')"))
+    if not sketches:
+        for table, bucket in rollup_buckets:
+            cur.execute("ALTER TABLE %s ADD COLUMN query_time_sketch TEXT NOT NULL DEFAULT ''" % table)
+    if not rollups:
+        # Fill the new rollup tables from the stats of earlier versions
+        for table, bucket in rollup_buckets:
+            cur.execute("INSERT INTO %s (query_id, unixdate, execution_count, min_unixdate, max_unixdate, sum_query_time, max_query_time, sum_lock_time, max_lock_time, sum_rows_sent, max_rows_sent, sum_rows_examined, max_rows_examined) SELECT query_id, %s, COUNT(*), MIN(unixdate), MAX(unixdate), SUM(query_time), MAX(query_time), SUM(lock_time), MAX(lock_time), SUM(rows_sent), MAX(rows_sent), SUM(rows_examined), MAX(rows_examined) FROM stats GROUP BY 1, 2" % (table, bucket))
+    if not rollups or not sketches:
+        # Fill the query time sketches of earlier versions from the stats
+        for table, bucket in rollup_buckets:
+            rollup_sketches = {}
+            cur.execute("SELECT query_id, %s, query_time FROM stats" % bucket)
+            for query_id, unixdate, query_time in cur:
+                sketch_add(rollup_sketches.setdefault((query_id, int(unixdate)), {}), query_time)
+            cur.executemany("UPDATE %s SET query_time_sketch=? WHERE query_id=? AND unixdate=?" % table,
+                            [(dump_sketch(sketch),) + key for key, sketch in rollup_sketches.iteritems()])
+    # SELECT host,user,query,COUNT(unixdate) AS execution_count, avg(query_time) AS avg_query_time, max(query_time) AS max_query_time, sum(query_time) AS sum_query_time, avg(lock_time) AS avg_lock_time, max(lock_time) AS max_lock_time, sum(lock_time) AS sum_lock_time, avg(rows_examined) AS avg_rows_examined, max(rows_examined) AS max_rows_examined, sum(rows_examined) AS sum_rows_examined, avg(rows_sent) AS avg_rows_sent, max(rows_sent) AS max_rows_sent, sum(rows_sent) AS sum_rows_sent FROM stats LEFT JOIN hosts USING (host_id) LEFT JOIN users ON (users.user_id=stats.user_id) LEFT JOIN queries ON (queries.query_id=stats.query_id) GROUP BY stats.query_id ORDER BY sum_query_time DESC, avg_query_time DESC, max_query_time DESC, sum_lock_time DESC, avg_lock_time DESC, max_lock_time DESC, sum_rows_examined DESC, avg_rows_examined DESC, max_rows_examined DESC, execution_count DESC, sum_rows_sent DESC, avg_rows_sent DESC, max_rows_sent DESC;
+    return con
+
+def get_checkpoint_options():
+    """Return the options which change the unique query statistics, as
+    string to compare checkpoints with."""
+
+    return repr((min_query_time, min_rows_examined, include_hosts,
+                 exclude_hosts, include_users, exclude_users, include_queries,
+                 include_query_regexes, exclude_queries, date_first, date_last,
+                 fingerprint, max_query_bytes, bucket_size, max_groups,
+                 detail_count))
+
+def load_checkpoint(cur, run):
+    """Return an Aggregator with the unique queries of the last checkpoint
+    of the interrupted run of the same files, otherwise an empty one."""
+
+    aggregator = Aggregator()
+    cur.execute("SELECT options, state FROM checkpoints WHERE run=?", (run,))
+    row = cur.fetchone()
+    if row and row[0] == get_checkpoint_options():
+        import cPickle
+        import zlib
+        state = cPickle.loads(zlib.decompress(str(row[1])))
+        aggregator.queries, aggregator.samples, aggregator.errors = state
+    elif row:
+        print >>sys.stderr, "Ignoring the checkpoint of an interrupted run with other options"
+    return aggregator
+
+def save_checkpoint(cur, run, positions):
+    """Save the file positions and the unique queries read up to them and
+    commit them together with all stats rows written since the last
+    checkpoint. The transaction of the next checkpoint is started."""
+
+    import cPickle
+    import zlib
+    for name, pos in positions.iteritems():
+        cur.execute("REPLACE INTO files VALUES (?,?,strftime('%s','now'))",
+                    (name, pos))
+    state = ({}, {}, {})
+    if not no_output and not report_from_db:
+        state = (aggregator.queries, aggregator.samples, aggregator.errors)
+    cur.execute("REPLACE INTO checkpoints VALUES (?,?,?,strftime('%s','now'))",
+                (run, get_checkpoint_options(),
+                 buffer(zlib.compress(cPickle.dumps(state, 2), 1))))
+    cur.execute("COMMIT")
+    cur.execute("BEGIN")
+
+def find_date_range(f, cur=None):
+    """Return the offsets of f between which the entries of the --date range
+    are, searching the time ordered log from its current position on.
+
+    With cur, the "# Time:" lines read are kept in the time_index table to
+    narrow the searches of later runs.
+    """
+
+    start = f.tell()
+    end = os.fstat(f.fileno()).st_size
+    known = []
+    if cur is not None:
+        cur.execute("SELECT pos, unixdate FROM time_index WHERE file=? ORDER BY pos", (f.name,))
+        known = cur.fetchall()
+        # A rotated or rewritten file has other timestamps at the offsets
+        for pos, t in known[:1] + known[len(known)//2:][:1] + known[-1:]:
+            if pos >= end or read_time(f, pos) != t:
+                cur.execute("DELETE FROM time_index WHERE file=?", (f.name,))
+                known = []
                 break
+    probes = []
+    if date_first:
+        start, probes = find_time_offset(f, start, end,
+                                         lambda t: t >= date_first, known)
+    if date_last:
+        end, last_probes = find_time_offset(f, start, end,
+                                            lambda t: t > date_last, known)
+        probes += last_probes
+    if cur is not None and probes:
+        cur.executemany("INSERT OR REPLACE INTO time_index VALUES (?,?,?)",
+                        [(f.name, pos, t) for pos, t in probes])
+    f.seek(start)
+    return start, end
+
+def read_follow(infile, source):
+    """Process the new entries of infile until Ctrl+C (--follow)."""
+
+    global incremental
+
+    process = no_duplicates and aggregator.add or output_entry
+    if run_stats is not None:
+        run_stats.start_reading()
+    try:
+        # The stats rows are only written with their file offset by
+        # flush_follow()
+        for entry in parse_entries(follow_lines(infile, flush_follow)):
+            process(entry, source)
+    except KeyboardInterrupt:
+        pass
+    if run_stats is not None:
+        run_stats.stop_reading()
+    # Keep the last checkpoint, everything after it is read again
+    incremental = False
+    del aggregator.db_rows[:]
+
+def read_ranges(infiles, input_sources, checkpoint_run=None, read_ends=None):
+    """Process the entries of all infiles in byte ranges with --jobs worker
+    processes or in this process.
+
+    The ranges are at most max_range_size bytes, so the entries or stats
+    rows of a range held in memory are bounded. With a checkpoint_run, a
+    checkpoint is saved after the first range finished every
+    checkpoint_interval seconds. Uncompressed files are read up to their
+    offset in read_ends, if any.
+    """
+
+    if jobs > 1:
+        try:
+            import multiprocessing
+        except ImportError, e:
+            print >>sys.stderr, "ERROR: Python multiprocessing module not available"
+            sys.exit()
+    sizes = [os.fstat(infile.fileno()).st_size for infile in infiles]
+    read_ends = read_ends or {}
+    ends = [read_ends.get(infile.name, size)
+            for infile, size in zip(infiles, sizes)]
+    compressions = [get_compression(infile) for infile in infiles]
+    total = sum([end - infile.tell() for infile, end, compression in
+                 zip(infiles, ends, compressions) if not compression])
+    ranges = []
+    for index, (infile, end, compression) in enumerate(zip(infiles, ends,
+                                                           compressions)):
+        start = infile.tell()
+        source = input_sources.get(infile.name)
+        if start >= end:
+            continue
+        if compression:
+            ranges.append((infile.name, index, start, None, source))
+        else:
+            # Plain files are split by their share of the total size
+            count = max(-(-(end - start) * jobs // total),
+                        -(-(end - start) // max_range_size))
+            ranges.extend([(infile.name, index, first, last, source)
+                           for first, last in
+                           split_byte_ranges(infile, start, end, count)])
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+
+    def range_entries(ranges):
+        """Yield the entries of the ranges, which are parsed in this process
+        or merged with the RunStats of their worker."""
+
+        for args, outcome in range_outcomes(pool, ranges):
+            if outcome is None:
+                pool.terminate()
+                sys.exit()
+            result, worker_stats = outcome
+            if worker_stats is not None:
+                run_stats.merge(worker_stats)
+            elif run_stats is not None:
+                run_stats.start_reading()
+            for entry in result:
+                yield entry
+            if worker_stats is None and run_stats is not None:
+                run_stats.stop_reading()
 
-if con:
-    cur.execute("REPLACE INTO files VALUES (?,?,strftime('%s','now'))", (infile.name,infile.tell()))
-    con.commit()
-    con.close()
\ No newline at end of file
+    if no_duplicates:
+        file_ends = dict([(infile.name, size)
+                          for infile, size in zip(infiles, sizes)])
+        positions = {} # file name: end of the last finished range
+        next_checkpoint = time.time() + checkpoint_interval
+        for (name, index, start, end, source), outcome in range_outcomes(pool,
+                                                                         ranges):
+            if outcome is None:
+                pool.terminate()
+                sys.exit()
+            result, worker_stats = outcome
+            if worker_stats is not None:
+                run_stats.merge(worker_stats)
+            elif not isinstance(result, Aggregator):
+                # Aggregated like in a worker, with the stats rows in batches
+                entries = result
+                result = Aggregator()
+                result.origin = (index, start)
+                if run_stats is not None:
+                    run_stats.start_reading()
+                for entry in entries:
+                    result.add(entry, source)
+                    if len(result.db_rows) >= db_batch_size:
+                        write_stats(con, result.db_rows, not checkpoint_run)
+                if run_stats is not None:
+                    run_stats.stop_reading()
+            aggregator.merge(result)
+            if aggregator.db_rows:
+                write_stats(con, aggregator.db_rows, not checkpoint_run)
+            if checkpoint_run:
+                positions[name] = end is None and file_ends[name] or end
+                if time.time() >= next_checkpoint:
+                    save_checkpoint(cur, checkpoint_run, positions)
+                    next_checkpoint = time.time() + checkpoint_interval
+    else:
+        # The entries of each file are merged in time order as they come
+        for source, entry in merge_entries([(input_sources.get(infile.name),
+                                             range_entries([args for args in ranges
+                                                            if args[1] == index]))
+                                            for index, infile in enumerate(infiles)]):
+            output_entry(entry, source)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for infile, size in zip(infiles, sizes):
+        infile.seek(size)
+
+def read_merged(infiles, input_sources, read_ends=None):
+    """Process the entries of all infiles merged in time order, the
+    uncompressed ones up to their offset in read_ends, if any."""
+
+    # All files are read at the same time (external decompressors run in
+    # parallel)
+    process = no_duplicates and aggregator.add or output_entry
+    read_ends = read_ends or {}
+    if run_stats is not None:
+        run_stats.start_reading()
+    for source, entry in merge_entries([(input_sources.get(infile.name),
+                                         iter_entries(infile, True,
+                                                      read_ends.get(infile.name),
+                                                      parse_timestamps))
+                                        for infile in infiles]):
+        process(entry, source)
+        if len(aggregator.db_rows) >= db_batch_size:
+            write_stats(con, aggregator.db_rows)
+    if run_stats is not None:
+        run_stats.stop_reading()
+
+def filter_logs(inputs):
+    """Read the (file name, source) inputs and print or save their queries
+    as the options tell."""
+
+    global aggregator, con, cur
+
+    input_sources = dict(inputs)
+
+    infiles = [open(name, 'r') for name, source in inputs]
+    if report_from_db and not incremental:
+        infiles = [] # Only the database is read
+    elif follow and len(infiles) != 1:
+        print >>sys.stderr, "ERROR: --follow needs exactly one input file"
+        sys.exit()
+    elif follow and get_compression(infiles[0]):
+        print >>sys.stderr, "ERROR: --follow cannot read compressed files"
+        sys.exit()
+    elif daemon_socket and not infiles:
+        print >>sys.stderr, "ERROR: --daemon needs input files"
+        sys.exit()
+    elif daemon_socket and [infile for infile in infiles
+                            if get_compression(infile)]:
+        print >>sys.stderr, "ERROR: --daemon cannot read compressed files"
+        sys.exit()
+    elif not infiles:
+        try:
+            sys.stdin.tell()
+            infiles = [sys.stdin]
+        except IOError:
+            print >>sys.stderr, "ERROR: No input data on STDIN available"
+            sys.exit()
+
+    aggregator = Aggregator()
+    con = cur = None
+    if incremental or report_from_db or time_index:
+        con = open_database()
+        cur = con.cursor()
+
+    rotated = False
+    if incremental:
+        # Compressed files continue after their last stream, if more were appended
+        for infile in infiles:
+            cur.execute("SELECT last_pos FROM files WHERE file=?", (infile.name,))
+            row = cur.fetchone()
+            last_pos = row and row[0] or 0
+            if infile is not sys.stdin and\
+               last_pos > os.fstat(infile.fileno()).st_size:
+                last_pos = 0 # The file was rotated or truncated
+                rotated = True
+            if last_pos: infile.seek(last_pos) # TODO: infile != stdin
+            elif (follow or daemon_socket) and not row:
+                infile.seek(0, 2)
+    elif follow:
+        infiles[0].seek(0, 2) # Only new entries like tail -f -n 0
+
+    # Only the --date range of time ordered, seekable files is read
+    read_ends = {} # file name: offset after the range
+    if (date_first or date_last) and not follow and not daemon_socket:
+        for infile in infiles:
+            if infile is sys.stdin or get_compression(infile) or\
+               not stat.S_ISREG(os.fstat(infile.fileno()).st_mode):
+                continue
+            pos = infile.tell()
+            start, end = find_date_range(infile, time_index and cur or None)
+            read_ends[infile.name] = end
+            if run_stats is not None:
+                run_stats.count('bytes skipped by --date',
+                    os.fstat(infile.fileno()).st_size - pos - max(end - start, 0))
+
+    # Checkpoints are identified by the names of the input files
+    checkpoint_run = None
+    if incremental and no_duplicates and checkpoint_interval and\
+       not follow and not daemon_socket and\
+       infiles and sys.stdin not in infiles:
+        checkpoint_run = hashlib.md5(u'\n'.join(sorted([infile.name for infile
+                                     in infiles])).encode('utf-8')).hexdigest()
+        if not rotated:
+            aggregator = load_checkpoint(cur, checkpoint_run)
+        # Everything up to the next checkpoint is committed at once
+        cur.execute("BEGIN")
+
+    if not infiles:
+        pass # --report-from-db without --incremental
+    elif daemon_socket:
+        serve_daemon(infiles, input_sources)
+    elif follow:
+        read_follow(infiles[0], input_sources.get(infiles[0].name))
+    elif (jobs > 1 or checkpoint_run) and sys.stdin not in infiles:
+        read_ranges(infiles, input_sources, checkpoint_run, read_ends)
+    else:
+        read_merged(infiles, input_sources, read_ends)
+    for infile in infiles:
+        if infile.name in read_ends:
+            infile.seek(0, 2) # The rest is after the --date range
+
+    if aggregator.db_rows:
+        write_stats(con, aggregator.db_rows, not checkpoint_run)
+
+    # The --daemon only answers report requests on its socket
+    if report_from_db and not daemon_socket:
+        aggregator = read_rollups(cur)
+
+    if no_duplicates and not daemon_socket:
+        aggregator.report()
+    if record_writer is not None:
+        record_writer.flush()
+
+    if incremental:
+        for infile in infiles:
+            cur.execute("REPLACE INTO files VALUES (?,?,strftime('%s','now'))", (infile.name,infile.tell()))
+    if checkpoint_run:
+        cur.execute("DELETE FROM checkpoints WHERE run=?", (checkpoint_run,))
+        cur.execute("COMMIT")
+    if con:
+        con.commit()
+        con.close()
+
+def main(argv=None):
+    """Filter the slow logs as the command line arguments argv (default:
+    sys.argv[1:]) tell."""
+
+    global run_stats
+
+    # http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/52560
+    locale.setlocale(locale.LC_NUMERIC,
+                     os.name == 'nt' and 'en' or 'en_US.ISO8859-1')
+    if argv is None:
+        # Decode all parameters to Unicode before parsing
+        fs_encoding = sys.getfilesystemencoding()
+        argv = [s.decode(fs_encoding) for s in sys.argv[1:]]
+    inputs = parse_args(argv)
+    if query_socket:
+        query_daemon([arg for arg in argv if arg[:15] != '--query-daemon='])
+        return
+
+    # Without --stats and --profile nothing is measured at all
+    if not collect_stats and not profile_file:
+        filter_logs(inputs)
+        return
+    start, times = time.time(), os.times()
+    originals = None
+    if collect_stats:
+        run_stats = RunStats()
+        originals = instrument_phases(run_stats)
+    profiler = None
+    try:
+        if profile_file:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.runcall(filter_logs, inputs)
+        else:
+            filter_logs(inputs)
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(profile_file)
+        if originals is not None:
+            restore_phases(originals)
+            print_run_stats(run_stats, time.time() - start, times)
+            run_stats = None
+
+
+ls = os.linesep
+date_format = '%Y-%m-%d %H:%M:%S'
+default_sorting = [4, 'sum-query-time', 2, 'avg-query-time', 3, 'max-query-time',
+                   7, 'sum-lock-time', 5, 'avg-lock-time', 6, 'max-lock-time',
+                   13, 'sum-rows-examined', 11, 'avg-rows-examined',
+                   12, 'max-rows-examined', 1, 'execution-count',
+                   10, 'sum-rows-sent', 8, 'avg-rows-sent', 9, 'max-rows-sent']
+first_chars = lambda words: ''.join([word[0] for word in words])
+# TODO: Is there an easier way to extend with each of the two value pairs?
+for t in [[default_sorting[i], first_chars(default_sorting[i+1].split('-'))]
+    for i in range(0, len(default_sorting), 2)]:
+  default_sorting.extend(t)
+# The QueryStats attributes of the sort_report() data columns, which are no averages
+sort_attributes = {1: 'execution_count', 3: 'max_query_time',
+                   4: 'sum_query_time', 6: 'max_lock_time', 7: 'sum_lock_time',
+                   9: 'max_rows_sent', 10: 'sum_rows_sent',
+                   12: 'max_rows_examined', 13: 'sum_rows_examined'}
+# Percentiles are only sorted by if requested, their short forms keep the number
+percentiles = [(16, 50), (17, 95), (18, 99)]
+for i, p in percentiles:
+    default_sorting.extend([i, 'p%d-query-time' % p, i, 'p%dqt' % p])
+sketch_accuracy = 0.01
+sketch_gamma = (1 + sketch_accuracy) / (1 - sketch_accuracy)
+sketch_log_gamma = math.log(sketch_gamma)
+sketch_indexes = {} # value: bucket index
+timestamp_cache = {}
+day_cache = {}
+poll_interval = 1.0
+head_size = 256 # first bytes of a followed file to detect rewrites
+follow_reset = '# -\n' # yielded by follow_lines() after a rotation
+daemon_request_timeout = 10.0 # seconds to wait for a --daemon request line
+daemon_request_bytes = 64 * 1024
+bucket_cache = {} # hour: day number
+write_buffer_size = 64 * 1024
+entry_fields = ['time', 'unixtime', 'source', 'user', 'host', 'query_time',
+                'lock_time', 'rows_sent', 'rows_examined', 'query']
+# The fields after max_timestamp are not written as CSV
+report_fields = ['query', 'fingerprint', 'execution_count', 'avg_query_time',
+                 'max_query_time', 'sum_query_time', 'avg_lock_time',
+                 'max_lock_time', 'sum_lock_time', 'avg_rows_sent',
+                 'max_rows_sent', 'sum_rows_sent', 'avg_rows_examined',
+                 'max_rows_examined', 'sum_rows_examined', 'p50_query_time',
+                 'p95_query_time', 'p99_query_time', 'min_timestamp',
+                 'max_timestamp', 'users', 'sources', 'buckets']
+bucket_fields = ['bucket', 'query', 'execution_count', 'sum_query_time',
+                 'max_query_time']
+db_batch_size = 10000
+max_range_size = 16 * 1024 * 1024 # of a read_ranges() byte range
+stats_phases = ['reading and parsing', 'timestamps', 'filters', 'aggregation',
+                'database', 'output']
+# Printed in this order, the --date ones only with a --date range
+stats_counters = ['lines read', 'bytes skipped by --date', 'entries seen',
+                  'rejected by --date', 'rejected by user/host filters',
+                  'passed user/host filters', 'rejected by -T/-R',
+                  'rejected by query filters', 'entries passed',
+                  'unique queries', 'database rows written']
+aggregator = None # of main()
+con = cur = None
+run_stats = None # RunStats with --stats
+
+# Default options for library use, iter_entries() parses the timestamps
+# regardless of them
+parse_args([])
+
+if __name__ == '__main__':
+    main()